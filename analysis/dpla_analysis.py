@@ -1,3 +1,4 @@
+import gzip
 import hashlib
 import sys
 import pprint
@@ -44,19 +45,19 @@ class Record:
                                     for item3 in item2:
                                         out.append((', '.join(item3)).encode("utf-8").strip())
                                 elif isinstance(item2, dict):
-                                    for key3, value3 in item2.iteritems():
+                                    for key3, value3 in item2.items():
                                         out.append((', '.join(value3)).encode("utf-8").strip())
                                 else:
                                     out.append(item2.encode("utf-8").strip())
                         elif isinstance(item, dict):
-                            for key, value in item.iteritems():
+                            for key, value in item.items():
                                 if isinstance(value, list):
                                     for item2 in value:
                                         if isinstance(item2, list):
                                             for item3 in item2:
                                                 out.append((', '.join(item3)).encode("utf-8").strip())
                                         elif isinstance(item2, dict):
-                                            for key3, value3 in item2.iteritems():
+                                            for key3, value3 in item2.items():
                                                 out.append((', '.join(valu3)).encode("utf-8").strip())
                                         else:
                                             out.append(item2.encode("utf-8").strip())
@@ -66,7 +67,7 @@ class Record:
                                             for value3 in value2:
                                                 out.append((', '.join(value3)).encode("utf-8").strip())
                                         if isinstance(value2, dict):
-                                            for key3, value3 in value2.iteritems():
+                                            for key3, value3 in value2.items():
                                                 out.append((', '.join(value3)).encode("utf-8").strip())
                                         else:
                                             out.append(value2.encode("uft-8").strip())
@@ -75,36 +76,36 @@ class Record:
                         else:
                             out.append(response.encode("utf-8").strip())
                 elif isinstance(response, dict):
-                    for key,value in response.iteritems():
+                    for key,value in response.items():
                         if isinstance(value, list):
                             for item2 in value:
                                 if isinstance(item2, list):
                                     for item3 in item2:
                                         out.append((', '.join(item3)).encode("utf-8").strip())
                                 elif isinstance(item2, dict):
-                                    for key3, value3 in item2.iteritems():
+                                    for key3, value3 in item2.items():
                                         out.append((', '.join(value3)).encode("utf-8").strip())
                                 else:
                                     out.append(item2.encode("utf-8").strip())
                         elif isinstance(value, dict):
-                            for key,value in value.iteritems():
+                            for key,value in value.items():
                                 if isinstance(value, list):
                                     for item2 in value:
                                         if isinstance(item2, list):
                                             for item3 in item2:
                                                 out.append((', '.join(item3)).encode("utf-8").strip())
                                         elif isinstance(item2, dict):
-                                            for key3, value3 in item2.iteritems():
+                                            for key3, value3 in item2.items():
                                                 out.append((', '.join(value3)).encode("utf-8").strip())
                                         else:
                                             out.append(item2.encode("utf-8").strip())
                                 elif isinstance(value, dict):
-                                    for key2, value2 in value.iteritems():
+                                    for key2, value2 in value.items():
                                         if isinstance(value2, list):
                                             for value3 in value2:
                                                 out.append((', '.join(value3)).encode("utf-8").strip())
                                         if isinstance(value2, dict):
-                                            for key3, value3 in value2.iteritems():
+                                            for key3, value3 in value2.items():
                                                 out.append((', '.join(value3)).encode("utf-8").strip())
                                         else:
                                             out.append(value2.encode("uft-8").strip())
@@ -114,7 +115,7 @@ class Record:
                             out.append(response.encode("utf-8").strip())
                 else:
                     out.append(response.encode("utf-8").strip())
-        except Exception,e:
+        except Exception as e:
             pass
         if len(out) == 0:
             out = None
@@ -123,13 +124,13 @@ class Record:
 
     def get_stats(self):
         stats = {}
-        for field,value in self.elem.iteritems():
+        for field,value in self.elem.items():
             if isinstance(value, dict):
-                for field2,value2 in value.iteritems():
+                for field2,value2 in value.items():
                     if isinstance(value2, dict):
-                        for field3,value3 in value2.iteritems():
+                        for field3,value3 in value2.items():
                             if isinstance(value3, dict):
-                                for field4, value4 in value3.iteritems():
+                                for field4, value4 in value3.items():
                                     stats.setdefault(field + "." + field2 + "." + field3 + "." + field4,0)
                                     stats[field + "." + field2 + "." + field3 + "." + field4] += 1
                             else:
@@ -155,6 +156,66 @@ class Record:
             present = True
             return present
 
+def element_in_fields(element, fields):
+    """Whether an ObjectPath element like $.sourceResource.subject.name is
+    within the fields a projected harvest fetched"""
+    path = re.split(r"[\[\s]", re.sub(r"^\$\.?", "", element))[0]
+    for field in fields:
+        if path == field or path.startswith(field + ".") or field.startswith(path + "."):
+            return True
+    return False
+
+# The start of a datafile: a {"docs": [...]} file, with or without the
+# fields harvested ahead of the docs, or a {"fields": [...]} line heading JSON
+# lines
+DOCS_START = re.compile(br'\s*\{\s*"docs"\s*:')
+FIELDS_START = re.compile(br'\s*\{\s*"fields"\s*:\s*\[[^\]]*\]\s*([,}])')
+
+def open_docs(datafile):
+    """Return the harvested fields (or None) and an iterator over the records
+    of a datafile: a {"docs": [...]} file, or JSON lines read as a stream,
+    such as a harvestDPLA.py .jsonl file or a DPLA bulk download with the
+    record under _source. Files ending in .gz are read gzipped. Only the
+    start of the file is looked at to tell them apart, so a docs file is
+    parsed once."""
+    if datafile.endswith(".gz"):
+        data = gzip.open(datafile, "rb")
+    else:
+        data = open(datafile, "rb")
+    start = data.read(4096)
+    data.seek(0)
+    fields = FIELDS_START.match(start)
+    if DOCS_START.match(start) or (fields and fields.group(1) == b","):
+        with data:
+            DPLAdata = json.load(data)
+        return DPLAdata.get("fields"), iter(DPLAdata["docs"])
+    if fields:
+        return json.loads(data.readline())["fields"], stream_docs(data)
+    return None, stream_docs(data)
+
+def stream_docs(data):
+    """Yield the records of JSON lines one at a time"""
+    with data:
+        for line in data:
+            if line.strip():
+                doc = json.loads(line)
+                yield doc.get("_source", doc)
+
+def names(value):
+    """The names in a provider or dataProvider value: a string, an object
+    with a name, or a list of either"""
+    if not isinstance(value, list):
+        value = [value]
+    return [v.get("name") if isinstance(v, dict) else v for v in value]
+
+def matches(doc, args):
+    """Whether a record is from the provider and dataProvider asked for"""
+    if args.provider and args.provider not in names(doc.get("provider")):
+        return False
+    if args.data_provider and args.data_provider not in names(doc.get("dataProvider")):
+        return False
+    return True
+
 def collect_stats(stats_aggregate, stats):
     #increment the record counter
     stats_aggregate["record_count"] += 1
@@ -215,23 +276,23 @@ def pretty_print_stats(stats_averages):
         if element_length < len(element):
             element_length = len(element)
 
-    print "\n\n"
+    print("\n\n")
     for element in sorted(stats_averages["field_info"]):
         percent = (stats_averages["field_info"][element]["field_count"] / float(record_count)) * 100
-        percentPrint = "=" * (int(percent) / 4)
+        percentPrint = "=" * (int(percent) // 4)
         columnOne = " " * (element_length - len(element)) + element
-        print "%s: |%-25s| %6s/%s | %3d%% " % (
+        print("%s: |%-25s| %6s/%s | %3d%% " % (
             columnOne,
             percentPrint,
             stats_averages["field_info"][element]["field_count"],
             record_count,
             percent
-        )
+        ))
 
-    print "\n"
+    print("\n")
     completeness = calc_completeness(stats_averages)
     for i in ["collection_completeness"]:
-        print "%23s %f" % (i, completeness[i])
+        print("%23s %f" % (i, completeness[i]))
 
 
 def main():
@@ -246,6 +307,8 @@ def main():
     parser.add_argument("-i", "--id", action="store_true", dest="id", default=False, help="prepend meta_id to line")
     parser.add_argument("-s", "--stats", action="store_true", dest="stats", default=False, help="only print stats for repository")
     parser.add_argument("-p", "--present", action="store_true", dest="present", default=False, help="print if there is value of defined element in record")
+    parser.add_argument("--provider", dest="provider", help="only records from this provider.name (hub)")
+    parser.add_argument("--data-provider", dest="data_provider", help="only records from this dataProvider (institution)")
     parser.add_argument("datafile", help="put the datafile you want analyzed here")
 
     args = parser.parse_args()
@@ -258,32 +321,38 @@ def main():
         args.stats = True
 
     s = 0
-    with open(args.datafile) as data:
-        DPLAdata = json.load(data)
-    records = DPLAdata['docs']
-    numberRecords = len(records)
+    # JSON lines and bulk downloads are read a record at a time
+    fields, records = open_docs(args.datafile)
+
+    # harvestDPLA.py --fields records which fields it fetched
+    if fields:
+        if args.element and not element_in_fields(args.element, fields):
+            sys.stderr.write("WARNING: %s was not harvested, only %s\n" % (args.element, ", ".join(fields)))
+        if args.stats is True and args.element is None:
+            print("Harvested fields: %s" % ", ".join(fields))
 
-    for n in range(0, numberRecords):
-        record = Record(records[n], args)
+    for doc in records:
+        if not matches(doc, args):
+            continue
+        record = Record(doc, args)
         record_id = record.get_record_id()
 
         if args.stats is False and args.present is False:
             if record.get_elements() is not None:
                 for i in record.get_elements():
                     if args.id:
-                        print "\t".join([record_id, i])
+                        print("\t".join([record_id, i]))
                     else:
-                        print i
+                        print(i)
 
         if args.stats is False and args.present is True:
-            print "%s %s" % (record_id, record.has_element())
+            print("%s %s" % (record_id, record.has_element()))
 
         if args.stats is True and args.element is None:
             if (s % 1000) == 0 and s != 0:
-                print "%d records processed" % s
+                print("%d records processed" % s)
             s += 1
             collect_stats(stats_aggregate, record.get_stats())
-        n += 1
 
     if args.stats is True and args.element is None:
         stats_averages = create_stats_averages(stats_aggregate)
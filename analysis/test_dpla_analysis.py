@@ -0,0 +1,86 @@
+"""Testing How the DPLA Analysis Reads Harvested and Bulk Download Files."""
+import unittest
+import dpla_analysis
+import gzip
+import io
+import json
+import os
+import tempfile
+from argparse import Namespace
+
+DOCS = [{'id': 'a', 'provider': {'name': 'Hub One'},
+         'dataProvider': 'Library A'},
+        {'id': 'b', 'provider': {'name': 'Hub Two'},
+         'dataProvider': ['Library B', 'Library C']}]
+
+
+class OpenDocs(unittest.TestCase):
+    """Every Datafile Layout Gives the Same Records."""
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmpdir = tmpdir.name
+
+    def datafile(self, name, text):
+        fname = os.path.join(self.tmpdir, name)
+        opener = gzip.open if name.endswith('.gz') else open
+        with opener(fname, 'wb') as dfile:
+            dfile.write(text.encode('utf-8'))
+        return(fname)
+
+    def readDocs(self, name, text):
+        fields, records = dpla_analysis.open_docs(self.datafile(name, text))
+        return(fields, list(records))
+
+    def testDocsFile(self):
+        self.assertEqual(self.readDocs('dpla.json', json.dumps({'docs': DOCS})),
+                         (None, DOCS))
+        self.assertEqual(self.readDocs('dpla.json.gz',
+                                       '\n  ' + json.dumps({'docs': DOCS})),
+                         (None, DOCS))
+
+    def testDocsFileWithFields(self):
+        text = '{"fields": ["id", "provider"],\n "docs": [%s]}' % (
+            ',\n'.join(json.dumps(doc) for doc in DOCS))
+        self.assertEqual(self.readDocs('dpla.json', text),
+                         (['id', 'provider'], DOCS))
+
+    def testJSONLines(self):
+        lines = '\n'.join(json.dumps(doc) for doc in DOCS) + '\n'
+        self.assertEqual(self.readDocs('dpla.jsonl', lines), (None, DOCS))
+        self.assertEqual(self.readDocs('dpla.jsonl.gz',
+                                       '{"fields": ["id"]}\n' + lines),
+                         (['id'], DOCS))
+
+    def testBulkDownload(self):
+        lines = '\n\n'.join(json.dumps({'_id': doc['id'], '_source': doc})
+                            for doc in DOCS)
+        self.assertEqual(self.readDocs('bulk.json.gz', lines), (None, DOCS))
+
+    def testStreamDocs(self):
+        data = io.BytesIO(b'{"id": "a"}\n\n{"_source": {"id": "b"}}\n')
+        self.assertEqual(list(dpla_analysis.stream_docs(data)),
+                         [{'id': 'a'}, {'id': 'b'}])
+        self.assertTrue(data.closed)
+
+
+class Matches(unittest.TestCase):
+    """Filtering Records by Hub and Institution."""
+
+    def matching(self, provider=None, data_provider=None):
+        args = Namespace(provider=provider, data_provider=data_provider)
+        return([doc['id'] for doc in DOCS if dpla_analysis.matches(doc, args)])
+
+    def testMatches(self):
+        self.assertEqual(self.matching(), ['a', 'b'])
+        self.assertEqual(self.matching(provider='Hub Two'), ['b'])
+        self.assertEqual(self.matching(data_provider='Library A'), ['a'])
+        self.assertEqual(self.matching(data_provider='Library C'), ['b'])
+        self.assertEqual(self.matching('Hub One', 'Library C'), [])
+        self.assertEqual(dpla_analysis.names([{'name': 'Hub'}, 'Library']),
+                         ['Hub', 'Library'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+"""Benchmark harvestOAI and harvestDPLA Against the Local Stand-in Server.
+
+Reports records/sec and bytes/sec for each harvest path, so changes to the
+harvest code can be compared without the network or a live endpoint getting
+in the way.
+
+usage: python benchHarvest.py [-r records] [--latency secs] [--gzip]
+"""
+from __future__ import unicode_literals
+import os
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+import harvestDPLA
+import harvestOAI
+import harvestTransport
+import standinServer
+
+
+def quietly(func, *args):
+    """Run func without the harvesters' per-page progress output."""
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return(func(*args))
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def resetStats():
+    for key in harvestTransport.stats:
+        harvestTransport.stats[key] = 0
+
+
+def benchOAI(baseURL, prefetch):
+    ofile = tempfile.TemporaryFile()
+    writer = harvestOAI.RecordWriter(ofile)
+    writer.start()
+    command = 'ListRecords&metadataPrefix=oai_dc'
+    if prefetch:
+        return(quietly(harvestOAI.harvestPipelined, baseURL + '/oai', command,
+                       writer, prefetch))
+    return(quietly(harvestOAI.harvestRecords, baseURL + '/oai', command,
+                   writer))
+
+
+def benchDPLA(baseURL, workers):
+    dplaAPI = baseURL + '/v2/items?api_key=bench'
+    callOpts = '&q=bench'
+    writer = harvestDPLA.DocWriter(os.path.join(tempfile.mkdtemp(),
+                                                'bench.jsonl'))
+    data = quietly(harvestDPLA.dataAPIcall, dplaAPI, callOpts, '1')
+    try:
+        return(quietly(harvestDPLA.iterateRecordPull, data, dplaAPI, callOpts,
+                       writer, workers))
+    finally:
+        writer.close()
+
+
+def report(name, func, *args):
+    resetStats()
+    start = time.time()
+    records = func(*args)
+    elapsed = time.time() - start
+    stats = harvestTransport.stats
+    print("%-22s %8d records %8.2fs %10.1f rec/s %10.1f KB/s wire %10.1f KB/s decoded"
+          % (name, records, elapsed, records / elapsed,
+             stats['wireBytes'] / elapsed / 1024,
+             stats['decodedBytes'] / elapsed / 1024))
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("-r", "--records", dest="records", type=int,
+                        default=5000, help="number of synthetic records")
+    parser.add_argument("--page-size", dest="pageSize", type=int, default=100,
+                        help="records per ListRecords page")
+    parser.add_argument("--latency", dest="latency", type=float, default=0.02,
+                        help="seconds the server waits before each response")
+    parser.add_argument("--fail-every", dest="failEvery", type=int, default=0,
+                        help="answer every Nth request with a 503")
+    parser.add_argument("--gzip", dest="gzip", default=False,
+                        action="store_true", help="gzip responses when asked")
+    args = parser.parse_args()
+
+    server = standinServer.startServer(records=args.records,
+                                       pageSize=args.pageSize,
+                                       latency=args.latency,
+                                       failEvery=args.failEvery,
+                                       retryAfter=0, gzip=args.gzip)
+    print("Stand-in server at %s: %d records, %.3fs latency%s"
+          % (server.baseURL, args.records, args.latency,
+             ', gzip' if args.gzip else ''))
+
+    report("OAI serial", benchOAI, server.baseURL, 0)
+    report("OAI pipelined (4)", benchOAI, server.baseURL, 4)
+    report("DPLA serial", benchDPLA, server.baseURL, 1)
+    report("DPLA concurrent (4)", benchDPLA, server.baseURL, 4)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
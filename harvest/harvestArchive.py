@@ -0,0 +1,142 @@
+"""Archive of Raw Harvested Pages, for Rebuilding a Harvest Offline.
+
+Each page is stored as a WARC-style 'resource' record, compressed as its own
+gzip member (as .warc.gz files are), with the request URL and the OAI-PMH
+command that fetched it in its header:
+
+    WARC/1.0
+    WARC-Type: resource
+    WARC-Target-URI: https://example.org/oai?verb=ListRecords&resumptionToken=...
+    Harvest-Command: ListRecords&resumptionToken=...
+    Content-Length: 123456
+
+The archive is appended to, so a page fetched again (a retry, or a rerun)
+replaces the earlier copy when the archive is read back by URL. A record
+cut off while it was being written is skipped when reading, along with
+nothing else: pages appended by later runs are still found after it.
+"""
+import gzip
+import threading
+import uuid
+import zlib
+from datetime import datetime
+
+BLOCK_SIZE = 1024 * 1024
+# The Start of Every Record: a gzip Member Header, Deflate Compressed
+GZIP_MAGIC = b'\x1f\x8b\x08'
+
+
+class PageArchive(object):
+    """Append raw pages to an archive file, from any number of threads."""
+    def __init__(self, fname):
+        self.afile = open(fname, 'ab')
+        self.lock = threading.Lock()
+        self.pageCount = 0
+
+    def write(self, url, command, data):
+        head = '\r\n'.join([
+            'WARC/1.0',
+            'WARC-Type: resource',
+            'WARC-Record-ID: <urn:uuid:%s>' % uuid.uuid4(),
+            'WARC-Date: %s' % datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'WARC-Target-URI: %s' % url,
+            'Harvest-Command: %s' % command,
+            'Content-Type: text/xml',
+            'Content-Length: %d' % len(data)]) + '\r\n\r\n'
+        member = gzip.compress(head.encode('utf-8') + data + b'\r\n\r\n',
+                               compresslevel=6)
+        with self.lock:
+            self.afile.write(member)
+            self.afile.flush()
+            self.pageCount += 1
+
+    def tee(self, chunks, url, command):
+        """Pass on a page's chunks, archiving the page once all of it has
+           been read. A page cut off part way isn't archived."""
+        page = []
+        for chunk in chunks:
+            page.append(chunk)
+            yield chunk
+        self.write(url, command, b''.join(page))
+
+    def close(self):
+        self.afile.close()
+
+
+def parseRecord(data):
+    """Split an archive record into its header fields and page."""
+    head, body = data.split(b'\r\n\r\n', 1)
+    fields = {}
+    for line in head.decode('utf-8').split('\r\n')[1:]:
+        name, value = line.split(':', 1)
+        fields[name] = value.strip()
+    return(fields, body[:int(fields['Content-Length'])])
+
+
+def findMember(afile, offset):
+    """Return the offset of the next gzip member starting at or after
+       offset, or None."""
+    afile.seek(offset)
+    tail = b''
+    while True:
+        block = afile.read(BLOCK_SIZE)
+        if not block:
+            return(None)
+        found = (tail + block).find(GZIP_MAGIC)
+        if found >= 0:
+            return(offset - len(tail) + found)
+        offset += len(block)
+        tail = block[-(len(GZIP_MAGIC) - 1):]
+
+
+def iterArchive(afile, offset=0):
+    """Yield (offset, header fields, page) for each record in an archive
+       file from offset on. A record cut off part way (a harvest stopped
+       while writing it) is skipped, and reading picks up again at the next
+       record, as a later harvest may have appended more after it."""
+    afile.seek(offset)
+    pending = b''
+    while True:
+        if not pending:
+            pending = afile.read(BLOCK_SIZE)
+            if not pending:
+                return
+        inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        out = []
+        length = 0
+        try:
+            while not inflater.eof:
+                if not pending:
+                    pending = afile.read(BLOCK_SIZE)
+                    if not pending:
+                        raise zlib.error("record cut off at the end")
+                out.append(inflater.decompress(pending))
+                length += len(pending) - len(inflater.unused_data)
+                pending = inflater.unused_data
+            fields, page = parseRecord(b''.join(out))
+        except (zlib.error, ValueError, KeyError):
+            # Look for the Next Record from Just After the Bad One's Start
+            offset = findMember(afile, offset + 1)
+            if offset is None:
+                return
+            afile.seek(offset)
+            pending = b''
+            continue
+        yield offset, fields, page
+        offset += length
+
+
+def indexArchive(fname):
+    """Map each WARC-Target-URI in an archive to the offset of its latest
+       page, so pages of different repositories are kept apart."""
+    index = {}
+    with open(fname, 'rb') as afile:
+        for offset, fields, page in iterArchive(afile):
+            index[fields['WARC-Target-URI']] = offset
+    return(index)
+
+
+def readPage(afile, offset):
+    """Read the page of the record at offset."""
+    for offset, fields, page in iterArchive(afile, offset):
+        return(page)
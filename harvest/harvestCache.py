@@ -0,0 +1,162 @@
+"""On-Disk Cache of API Responses, for Rerunning the Same Queries Quickly.
+
+Each cached GET is stored under the SHA-256 of its request: the method and
+URL with the query parameters sorted, and the API key left out (so a key is
+never written to disk and changing keys doesn't empty the cache). A response
+newer than the TTL is answered straight from disk. An older one is
+revalidated with If-None-Match/If-Modified-Since when the server sent an ETag
+or Last-Modified, and a 304 makes it fresh again. Once the cache is over its
+size the least recently used responses are removed.
+
+Layout, two files per response:
+
+    cache/3f/3f2a...e1.json    the URL, headers and time it was stored
+    cache/3f/3f2a...e1.body    the decoded body
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import timedelta
+from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse
+import requests
+from requests.structures import CaseInsensitiveDict
+
+EXCLUDED_PARAMS = ('api_key',)
+KEPT_HEADERS = ('Content-Type', 'ETag', 'Last-Modified')
+
+
+def requestURL(url, params=None):
+    """The URL of a request with its params added and sorted, and the API
+       key left out."""
+    parts = urlparse(url)
+    query = parse_qsl(parts.query, keep_blank_values=True)
+    if params:
+        query.extend((k, str(v)) for k, v in sorted(params.items()))
+    query = sorted((k, v) for k, v in query if k not in EXCLUDED_PARAMS)
+    return(urlunparse(parts._replace(query=urlencode(query))))
+
+
+class ResponseCache(object):
+    """Cached responses in directory, fresh for ttl seconds, keeping the
+       total size under maxBytes."""
+    def __init__(self, directory, ttl, maxBytes):
+        self.directory = directory
+        self.ttl = ttl
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.revalidated = 0
+        # Sizes of the Cached Responses, by Key, for Eviction
+        self.sizes = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for root, dirs, files in os.walk(directory):
+            for fname in files:
+                if fname.endswith('.body'):
+                    self.sizes[fname[:-5]] = os.path.getsize(
+                        os.path.join(root, fname))
+        self.evict()
+
+    def key(self, method, url, params=None):
+        request = '%s %s' % (method, requestURL(url, params))
+        return(hashlib.sha256(request.encode('utf-8')).hexdigest())
+
+    def path(self, key, ext):
+        return(os.path.join(self.directory, key[:2], key + ext))
+
+    def lookup(self, key):
+        """The stored entry for key, or None."""
+        try:
+            with open(self.path(key, '.json')) as efile:
+                entry = json.load(efile)
+        except (IOError, OSError, ValueError):
+            return(None)
+        if not os.path.exists(self.path(key, '.body')):
+            return(None)
+        return(entry)
+
+    def fresh(self, entry):
+        return(time.time() - entry['stored'] < self.ttl)
+
+    def validators(self, entry):
+        """Conditional request headers to revalidate entry."""
+        headers = {}
+        if entry['headers'].get('ETag'):
+            headers['If-None-Match'] = entry['headers']['ETag']
+        if entry['headers'].get('Last-Modified'):
+            headers['If-Modified-Since'] = entry['headers']['Last-Modified']
+        return(headers)
+
+    def response(self, key, entry):
+        """A requests Response for a cached entry, marking it recently used."""
+        with open(self.path(key, '.body'), 'rb') as bfile:
+            body = bfile.read()
+        os.utime(self.path(key, '.body'), None)
+        resp = requests.Response()
+        resp.status_code = 200
+        resp.url = entry['url']
+        resp.headers = CaseInsensitiveDict(entry['headers'])
+        resp._content = body
+        resp.elapsed = timedelta(0)
+        resp.fromCache = True
+        with self.lock:
+            self.hits += 1
+        return(resp)
+
+    def refresh(self, key, entry):
+        """Mark entry fresh again after the server answered 304."""
+        entry['stored'] = time.time()
+        self.writeEntry(key, entry)
+        with self.lock:
+            self.revalidated += 1
+
+    def store(self, key, resp):
+        entry = {'url': requestURL(resp.url), 'stored': time.time(),
+                 'headers': dict((h, resp.headers[h]) for h in KEPT_HEADERS
+                                 if h in resp.headers)}
+        os.makedirs(os.path.dirname(self.path(key, '')), exist_ok=True)
+        # Write then Rename, so a Reader Never Sees Half a Response.
+        tmp = self.path(key, '.body.%d' % threading.get_ident())
+        with open(tmp, 'wb') as bfile:
+            bfile.write(resp.content)
+        os.replace(tmp, self.path(key, '.body'))
+        self.writeEntry(key, entry)
+        with self.lock:
+            self.sizes[key] = len(resp.content)
+        self.evict()
+
+    def writeEntry(self, key, entry):
+        tmp = self.path(key, '.json.%d' % threading.get_ident())
+        with open(tmp, 'w') as efile:
+            json.dump(entry, efile)
+        os.replace(tmp, self.path(key, '.json'))
+
+    def evict(self):
+        """Remove the least recently used responses until the cache fits in
+           maxBytes."""
+        with self.lock:
+            if sum(self.sizes.values()) <= self.maxBytes:
+                return
+            used = []
+            for key in self.sizes:
+                try:
+                    used.append((os.path.getmtime(self.path(key, '.body')), key))
+                except OSError:
+                    used.append((0, key))
+            total = sum(self.sizes.values())
+            for mtime, key in sorted(used):
+                if total <= self.maxBytes:
+                    break
+                for ext in ('.json', '.body'):
+                    try:
+                        os.remove(self.path(key, ext))
+                    except OSError:
+                        pass
+                total -= self.sizes.pop(key)
+
+    def report(self):
+        return("%d responses from the cache (%d revalidated), %.1f MB cached"
+               % (self.hits, self.revalidated,
+                  sum(self.sizes.values()) / 1048576.0))
@@ -1,9 +1,21 @@
 """Harvest Subset of DPLA Metadata from the DPLA API - Requires Auth."""
-from argparse import ArgumentParser
+from argparse import ArgumentParser, Namespace
+from datetime import date, timedelta
+from urllib.parse import quote
 import os
 import requests
+import harvestMetrics
+import harvestOutput
+import harvestTransport
+import harvestWorkers
 import json
+import threading
 import time
+from queue import Queue, Empty
+
+PAGE_SIZE = 500
+# The API Won't Page Past 100 Pages of 500 Records
+MAX_RESULTS = 50000
 
 
 def generateCallOpts(args):
@@ -23,69 +35,267 @@ def generateCallOpts(args):
     return(callOpts)
 
 
-def dataAPIcall(dplaAPI, verbOpts, page_num):
-    page_params = {'page_size': 500, 'page': page_num}
-    data = requests.get(dplaAPI + verbOpts, params=page_params)
-    req_url = data.url
-    print("Using url:%s" % req_url)
+def dataAPIcall(dplaAPI, verbOpts, page_num, page_size=PAGE_SIZE):
+    page_params = {'page_size': page_size, 'page': page_num}
 
+    # Transient Errors are Already Retried by the Transport.
     try:
-        if data.status_code != 200 and data.status_code != 301:
-            data.raise_for_status()
-        elif data.status_code == 301:
-            print("%s redirected to %s ." % dplaAPI + verbOpts, req_url)
-            return(dataAPIcall(data.url, verbOpts, page_num))
-        else:
-            data.encoding = 'utf-8'
+        data = harvestTransport.get(dplaAPI + verbOpts, params=page_params)
+        req_url = data.url
+        print("Using url:%s" % req_url)
+        data.raise_for_status()
+        data.encoding = 'utf-8'
     except requests.HTTPError as exValue:
         status_code = exValue.response.status_code
         if status_code == 503:
-            retryWait = int(data.headers.get("Retry-After", "-1"))
-            if retryWait < 0:
-                print("DPLA API Service %s Unavailable (Status 503)." % req_url)
-                exit()
-            else:
-                print('Waiting %d seconds' % retryWait)
-                time.sleep(retryWait)
-                return(dataAPIcall(dplaAPI, verbOpts, page_num))
+            print("DPLA API Service %s Unavailable (Status 503)." % req_url)
         elif status_code == 404:
             print("404 Not Found Error with API CALL: %s" % req_url)
-            exit()
         else:
             print(exValue)
-            exit()
+        exit()
+    except harvestTransport.HarvestError as exValue:
+        print(exValue)
+        exit()
     return(data)
 
 
-def iterateRecordPull(data, dplaAPI, callOpts):
-    recordlist = []
-    recordCount = 0
-    dplaRecordCount = data.json()['count']
-    dplaPageCount = (dplaRecordCount / 500) + 1
+class DocWriter(object):
+    """Write DPLA records to a file as they arrive: one JSON document per
+       line when the file name ends in .jsonl (before any compression
+       extension), otherwise streamed into a {"docs": [...]} document. With
+       dedup, records whose id has already been written are dropped. The
+       fields of a projected harvest head the file, as {"fields": [...]}
+       on the first line or in the document."""
+    def __init__(self, fname, dedup=False, fields=None):
+        self.lines = harvestOutput.splitFilename(fname)[1].startswith('.jsonl')
+        self.ofile = harvestOutput.openOutput(fname, text=True)
+        self.lock = threading.Lock()
+        self.seen = set() if dedup else None
+        self.fields = fields
+        self.recordCount = 0
+        self.duplicateCount = 0
+        if self.lines and fields:
+            self.ofile.write(json.dumps({'fields': fields}) + '\n')
+        elif fields:
+            self.ofile.write('{"fields": %s,\n "docs": [' % json.dumps(fields))
+        elif not self.lines:
+            self.ofile.write('{"docs": [')
+
+    def write(self, doc):
+        if self.seen is not None:
+            if doc['id'] in self.seen:
+                self.duplicateCount += 1
+                return
+            self.seen.add(doc['id'])
+        if self.lines:
+            self.ofile.write(json.dumps(doc) + '\n')
+        else:
+            self.ofile.write((',\n' if self.recordCount else '\n') +
+                             json.dumps(doc))
+        self.recordCount += 1
+
+    def flush(self):
+        """Push the records so far to disk, e.g. after every page."""
+        self.ofile.flush()
+
+    def close(self):
+        if not self.lines:
+            self.ofile.write('\n]}\n')
+        self.ofile.close()
+
 
-    for p in range(1, int(dplaPageCount) + 1):
-        for n in range(0, 500):
+def nestFields(doc):
+    """Turn the dotted keys of a projected record ("sourceResource.title")
+       back into the nested objects of a full record."""
+    nested = {}
+    for key, value in doc.items():
+        parts = key.split('.')
+        parent = nested
+        for part in parts[:-1]:
+            parent = parent.setdefault(part, {})
+        parent[parts[-1]] = value
+    return(nested)
+
+
+def writePage(data, writer, label):
+    """Decode a page of results once and write its records. Returns the
+       decoded page."""
+    pageStart = time.time()
+    page = data.json()
+    if writer.fields:
+        page['docs'] = [nestFields(doc) for doc in page['docs']]
+    decoded = time.time()
+    # Slices Harvested at Once Share the Writer.
+    with writer.lock:
+        written = writer.recordCount
+        for doc in page['docs']:
+            writer.write(doc)
+        writer.flush()
+        written = writer.recordCount - written
+    harvestMetrics.recordPage({'label': label, 'records': written,
+                               'decode': decoded - pageStart,
+                               'write': time.time() - decoded})
+    return(page)
+
+
+def fetchPages(dplaAPI, callOpts, pageNums, workers):
+    """Yield the response for each page in pageNums, in order, fetching up to
+       workers pages at once and holding no more than twice that many ahead
+       of the caller."""
+    pageNums = list(pageNums)
+    todo = Queue()
+    for p in pageNums:
+        todo.put(p)
+    results = dict((p, Queue(maxsize=1)) for p in pageNums)
+    ahead = threading.Semaphore(workers * 2)
+    stopped = threading.Event()
+
+    def work():
+        while True:
+            ahead.acquire()
+            if stopped.is_set():
+                return
             try:
-                DPLAobject = data.json()['docs'][n]
-                recordlist.append(DPLAobject)
-                n += 1
-                recordCount += 1
-            except IndexError:
-                break
-        p += 1
-        data = dataAPIcall(dplaAPI, callOpts, str(p))
+                p = todo.get(block=False)
+            except Empty:
+                return
+            try:
+                results[p].put(dataAPIcall(dplaAPI, callOpts, str(p)))
+            except BaseException as exValue:
+                # Hand failures (including exit()) to the caller to re-raise.
+                results[p].put(exValue)
+
+    threads = [threading.Thread(target=work)
+               for n in range(min(workers, len(pageNums)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        for p in pageNums:
+            data = results[p].get()
+            ahead.release()
+            if isinstance(data, BaseException):
+                raise data
+            yield p, data
+    finally:
+        # Let Workers Waiting for Room Finish Instead of Fetching More.
+        stopped.set()
+        for thread in threads:
+            ahead.release()
+
+
+def iterateRecordPull(data, dplaAPI, callOpts, writer, workers=1):
+    """Write the records of every page of results to writer, starting with
+       the first page's response data. The other pages are fetched workers
+       at a time and written in page order. Returns the number written."""
+    dplaRecordCount = writePage(data, writer, 'page 1')['count']
+    dplaPageCount = (dplaRecordCount + PAGE_SIZE - 1) // PAGE_SIZE
+    if dplaRecordCount > MAX_RESULTS:
+        print("WARNING: only %d of %d records can be paged through; use -s \
+to split the query" % (MAX_RESULTS, dplaRecordCount))
+        dplaPageCount = MAX_RESULTS // PAGE_SIZE
+
+    for p, data in fetchPages(dplaAPI, callOpts, range(2, dplaPageCount + 1),
+                              workers):
         print("Retrieving page %d of %d" % (p, dplaPageCount))
-    output = {}
-    output['recordCount'] = recordCount
-    output['recordlist'] = recordlist
-    return(output)
+        writePage(data, writer, 'page %d' % p)
+    return(writer.recordCount)
+
+
+def parseDate(value, end=False):
+    """The first day of a yyyy, yyyy-mm or yyyy-mm-dd date, or the last day
+       if end."""
+    parts = [int(part) for part in value.split('-')]
+    first = date(*(parts + [1] * (3 - len(parts))))
+    if not end or len(parts) == 3:
+        return(first)
+    elif len(parts) == 1:
+        return(date(first.year, 12, 31))
+    return((first.replace(day=28) + timedelta(days=4)).replace(day=1) -
+           timedelta(days=1))
+
+
+def countRecords(dplaAPI, callOpts, facet=None):
+    """The number of records matching a query, and with facet, the count
+       of each of that field's values."""
+    if facet:
+        callOpts += '&facets=%s&facet_size=2000' % facet
+    page = dataAPIcall(dplaAPI, callOpts, '1', page_size=0).json()
+    terms = {}
+    if facet:
+        for term in page.get('facets', {}).get(facet, {}).get('terms', []):
+            terms[term['term']] = term['count']
+    return(page['count'], terms)
+
+
+def sliceByDate(dplaAPI, args, maxResults):
+    """Split the query in args into date ranges matching at most maxResults
+       records each, halving any range that matches more. Returns a list of
+       (callOpts, count)."""
+    after = parseDate(args.afterDate) if args.afterDate else date(1, 1, 1)
+    before = (parseDate(args.beforeDate, end=True) if args.beforeDate
+              else date.today())
+    slices = []
+    todo = [(after, before)]
+    while todo:
+        after, before = todo.pop()
+        sliceArgs = Namespace(**dict(vars(args), afterDate=after.isoformat(),
+                                     beforeDate=before.isoformat()))
+        callOpts = generateCallOpts(sliceArgs)
+        count = countRecords(dplaAPI, callOpts)[0]
+        if count > maxResults and after < before:
+            middle = after + (before - after) // 2
+            todo.extend([(middle + timedelta(days=1), before), (after, middle)])
+        elif count:
+            if count > maxResults:
+                print("WARNING: %d records on %s, only %d can be paged through"
+                      % (count, after, maxResults))
+            slices.append((callOpts, count))
+    return(slices)
+
+
+def sliceQuery(dplaAPI, args, split, maxResults):
+    """Split the query in args into slices small enough to page through
+       fully: by date, or by contributing institution and then by date for
+       any institution with more than maxResults records. Returns a list of
+       (callOpts, count)."""
+    if split == 'date':
+        return(sliceByDate(dplaAPI, args, maxResults))
+    facet = 'admin.contributingInstitution'
+    slices = []
+    terms = countRecords(dplaAPI, generateCallOpts(args), facet)[1]
+    for term, count in sorted(terms.items()):
+        sliceArgs = Namespace(**dict(vars(args), provider=quote(term)))
+        if count > maxResults:
+            slices.extend(sliceByDate(dplaAPI, sliceArgs, maxResults))
+        else:
+            slices.append((generateCallOpts(sliceArgs), count))
+    return(slices)
+
+
+def harvestSlices(dplaAPI, slices, writer, workers):
+    """Harvest every slice into writer, workers slices at a time. Records
+       in more than one slice are written once if writer drops duplicates.
+       Returns the number of records written, or exits with status 1 once
+       the other slices are harvested if any slice fails."""
+    def harvestSlice(querySlice):
+        callOpts, count = querySlice
+        data = dataAPIcall(dplaAPI, callOpts, '1')
+        iterateRecordPull(data, dplaAPI, callOpts, writer)
+
+    failures = harvestWorkers.runWorkers(harvestSlice, slices, workers)
+    if failures:
+        print("%d of %d slices failed to harvest" % (len(failures), len(slices)))
+        exit(1)
+    return(writer.recordCount)
 
 
 def main():
     parser = ArgumentParser()
     parser.add_argument("-o", "--filename", dest="filename",
-                        help="write repository to file",
-                        default="DPLAharvest.json")
+                        help="write repository to file, as JSON Lines if it \
+                        ends in .jsonl", default="DPLAharvest.json")
     parser.add_argument("-k", "--apikey", dest="apikey",
                         help="your unique DPLA API key")
     parser.add_argument("-a", "--after", dest="afterDate",
@@ -100,8 +310,40 @@ def main():
                         help="specify a metadata provider / local institution")
     parser.add_argument("-u", "--hub", dest="hub",
                         help="specify a service or content hub")
+    parser.add_argument("-w", "--workers", dest="workers", type=int,
+                        default=4, help="number of pages to fetch from the \
+                        API at once")
+    parser.add_argument("--no-adaptive", dest="adaptive", default=True,
+                        action="store_false", help="always allow -w requests \
+                        in flight instead of adapting to the API's latency \
+                        and 429/503s")
+    parser.add_argument("--rate", dest="rate", type=float, default=0,
+                        help="requests a second allowed to the API, 0 for no \
+                        limit")
+    parser.add_argument("-s", "--slice", dest="split",
+                        choices=('date', 'institution'), help="split the query \
+                        into date ranges, or contributing institutions, small \
+                        enough to page through fully and harvest -w of them \
+                        at once, dropping records found in more than one")
+    parser.add_argument("--slice-size", dest="sliceSize", type=int,
+                        default=MAX_RESULTS, help="most records in one slice \
+                        (the API pages through at most %d)" % MAX_RESULTS)
+    parser.add_argument("--fields", dest="fields",
+                        help="comma-separated fields to fetch instead of the \
+                        whole record, e.g. sourceResource.subject,rights (id \
+                        is always fetched)")
+    harvestOutput.addArgument(parser)
+    harvestTransport.addCacheArguments(parser)
+    harvestMetrics.addArguments(parser)
     args = parser.parse_args()
 
+    # Record Metrics, Answer Repeated Requests from the Cache, and Add the
+    # Extension for Compressed Output, if Asked
+    harvestMetrics.enableFromArgs('harvestDPLA', args)
+    harvestTransport.setCacheFromArgs(args)
+    args.filename = harvestOutput.prepareFilename(parser, args.filename,
+                                                  args.compress)
+
     dplaAPI = 'https://api.dp.la/v2/items'
 
     # Check DPLA API Key as Argument or Environmental Variable
@@ -118,6 +360,13 @@ def main():
                      \nGet a DPLA API key here: \
                      \nhttp://dp.la/info/developers/codex/policies/#get-a-key")
 
+    # Ask for Only the Fields Wanted, and Always the id
+    fields = None
+    if args.fields:
+        fields = ['id'] + [field.strip() for field in args.fields.split(',')
+                           if field.strip() and field.strip() != 'id']
+        dplaAPI += '&fields=' + ','.join(fields)
+
     print("Writing records to %s from DPLA: %s" % (args.filename, dplaAPI))
 
     # Generate API Options and Cancel full DPLA Data Dump requests
@@ -128,21 +377,45 @@ def main():
         parser.print_help()
         exit()
 
-    # Call API for first 500 Records
-    data = dataAPIcall(dplaAPI, callOpts, '1')
+    # Keep a Pooled Connection Open for Each Concurrent Request, Within the
+    # API's Rate Limit, and Let the Transport Find How Many it Can Handle
+    harvestTransport.setPoolSize(args.workers)
+    harvestTransport.setRateLimit(args.rate or None, args.workers)
+    if args.adaptive:
+        harvestTransport.setAdaptive(args.workers)
 
-    # Iterate over Rest of Records & Create Dict for Writing to Json
-    dataDict = {}
-    output = iterateRecordPull(data, dplaAPI, callOpts)
-    recordCount = output['recordCount']
-    dataDict['docs'] = output['recordlist']
+    # Split Large Queries into Slices that can be Paged Through Fully
+    if args.split:
+        queryCount = countRecords(dplaAPI, callOpts)[0]
+        slices = sliceQuery(dplaAPI, args, args.split, args.sliceSize)
+        print("Harvesting %d records in %d slices"
+              % (sum(count for opts, count in slices), len(slices)))
+    else:
+        # Call API for first 500 Records
+        data = dataAPIcall(dplaAPI, callOpts, '1')
 
-    # Write Out JSON Data Harvest
-    ofile = open(args.filename, 'w')
-    json.dump(dataDict, ofile)
-    ofile.close()
+    # Iterate over Rest of Records, Writing Each Page Out as it Arrives.
+    # On Failure, Close the File so the Records so Far are Usable.
+    writer = DocWriter(args.filename, dedup=bool(args.split), fields=fields)
+    try:
+        if args.split:
+            recordCount = harvestSlices(dplaAPI, slices, writer, args.workers)
+        else:
+            recordCount = iterateRecordPull(data, dplaAPI, callOpts, writer,
+                                            args.workers)
+    finally:
+        writer.close()
 
+    print(harvestTransport.transferReport())
     print("Wrote out %d records" % recordCount)
+    if args.split:
+        print("Dropped %d records found in more than one slice"
+              % writer.duplicateCount)
+        if recordCount < queryCount:
+            print("WARNING: %d records match the query but only %d are in a \
+slice (those without a date or institution are left out)"
+                  % (queryCount, recordCount))
+    harvestMetrics.finish()
 
 
 if __name__ == '__main__':
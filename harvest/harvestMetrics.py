@@ -0,0 +1,174 @@
+"""Harvest Telemetry: Per-Request and Per-Page Metrics.
+
+Once enable() is called, every request the transport finishes and every page
+a harvester processes is written out as a JSON line. Totals per host and per
+processing stage are kept for a Prometheus textfile (for node_exporter's
+textfile collector) and for a summary printed at the end of the harvest.
+Until then the record functions do nothing.
+"""
+import atexit
+import json
+import os
+import threading
+import time
+
+recorder = None
+REQUEST_TIMES = ('dns', 'connect', 'firstByte', 'total')
+REQUEST_COUNTS = ('retries', 'wireBytes', 'decodedBytes')
+
+
+class MetricsRecorder(object):
+    """Collects the metrics of one harvester run."""
+    def __init__(self, job, jsonPath=None, promPath=None):
+        self.job = job
+        self.promPath = promPath
+        self.jsonFile = open(jsonPath, 'a') if jsonPath else None
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.hosts = {}
+        self.stages = {}
+        self.records = 0
+        self.pages = 0
+        self.totals = []
+
+    def emit(self, event, entry):
+        if self.jsonFile:
+            entry = dict(entry, event=event, job=self.job,
+                         time=round(time.time(), 3))
+            self.jsonFile.write(json.dumps(entry, sort_keys=True) + '\n')
+            self.jsonFile.flush()
+
+    def request(self, entry):
+        with self.lock:
+            host = self.hosts.setdefault(
+                entry['host'], dict((k, 0) for k in
+                                    ('requests',) + REQUEST_TIMES + REQUEST_COUNTS))
+            host['requests'] += 1
+            for key in REQUEST_TIMES + REQUEST_COUNTS:
+                host[key] += entry.get(key, 0)
+            self.totals.append(entry['total'])
+            self.emit('request', entry)
+
+    def page(self, entry):
+        with self.lock:
+            self.pages += 1
+            self.records += entry.get('records', 0)
+            for stage, seconds in entry.items():
+                if stage not in ('records', 'label'):
+                    self.stages[stage] = self.stages.get(stage, 0) + seconds
+            self.emit('page', entry)
+
+    def summary(self):
+        elapsed = time.time() - self.started
+        lines = ["Harvest metrics for %s:" % self.job]
+        for name, host in sorted(self.hosts.items()):
+            lines.append("  %s: %d requests, %d retries, %.1f MB wire, "
+                         "%.1f MB decoded" % (name, host['requests'],
+                                              host['retries'],
+                                              host['wireBytes'] / 1048576.0,
+                                              host['decodedBytes'] / 1048576.0))
+            lines.append("    mean dns %.3fs, connect %.3fs, first byte %.3fs, "
+                         "total %.3fs" % tuple(host[k] / float(host['requests'])
+                                               for k in REQUEST_TIMES))
+        if self.totals:
+            totals = sorted(self.totals)
+            lines.append("  request time p50 %.3fs, p95 %.3fs, max %.3fs"
+                         % (totals[len(totals) // 2],
+                            totals[int(len(totals) * 0.95)], totals[-1]))
+        lines.append("  %d records in %d pages, %.1fs (%.1f records/sec)"
+                     % (self.records, self.pages, elapsed,
+                        self.records / max(elapsed, 0.001)))
+        if self.stages:
+            lines.append("  stage time: " + ", ".join(
+                "%s %.2fs" % item for item in sorted(self.stages.items())))
+        return("\n".join(lines))
+
+    def prometheus(self):
+        """The metrics in the Prometheus text exposition format."""
+        job = 'job="%s"' % self.job
+        out = []
+
+        def metric(name, kind, helpText, samples):
+            out.append("# HELP %s %s" % (name, helpText))
+            out.append("# TYPE %s %s" % (name, kind))
+            for labels, value in samples:
+                out.append("%s{%s} %s" % (name, ','.join((job,) + labels), value))
+
+        hosts = sorted(self.hosts.items())
+        metric('harvest_requests_total', 'counter', 'Requests completed.',
+               [(('host="%s"' % n,), h['requests']) for n, h in hosts])
+        metric('harvest_retries_total', 'counter', 'Retried request attempts.',
+               [(('host="%s"' % n,), h['retries']) for n, h in hosts])
+        metric('harvest_wire_bytes_total', 'counter',
+               'Response bytes read off the wire.',
+               [(('host="%s"' % n,), h['wireBytes']) for n, h in hosts])
+        metric('harvest_decoded_bytes_total', 'counter',
+               'Response bytes after transfer decoding.',
+               [(('host="%s"' % n,), h['decodedBytes']) for n, h in hosts])
+        metric('harvest_request_seconds_total', 'counter',
+               'Time spent in each phase of the requests.',
+               [(('host="%s"' % n, 'phase="%s"' % k), '%.6f' % h[k])
+                for n, h in hosts for k in REQUEST_TIMES])
+        metric('harvest_stage_seconds_total', 'counter',
+               'Time spent in each stage of page processing.',
+               [(('stage="%s"' % k,), '%.6f' % v)
+                for k, v in sorted(self.stages.items())])
+        metric('harvest_records_total', 'counter', 'Records harvested.',
+               [((), self.records)])
+        metric('harvest_duration_seconds', 'gauge', 'Length of the harvest.',
+               [((), '%.3f' % (time.time() - self.started))])
+        return("\n".join(out) + "\n")
+
+    def close(self):
+        if self.promPath:
+            # Write then Rename, so the Collector Never Reads Half a File.
+            with open(self.promPath + '.tmp', 'w') as pfile:
+                pfile.write(self.prometheus())
+            os.rename(self.promPath + '.tmp', self.promPath)
+        if self.jsonFile:
+            self.jsonFile.close()
+
+
+def enable(job, jsonPath=None, promPath=None):
+    """Start recording metrics for job (the harvester or endpoint name)."""
+    global recorder
+    recorder = MetricsRecorder(job, jsonPath, promPath)
+    # Still Write the Metrics if the Harvest Stops with exit().
+    atexit.register(finish)
+    return(recorder)
+
+
+def addArguments(parser):
+    """Add the --metrics and --prom options to a harvester's ArgumentParser."""
+    parser.add_argument("--metrics", dest="metrics",
+                        help="write per-request and per-page metrics to this \
+                        file as JSON lines")
+    parser.add_argument("--prom", dest="prom",
+                        help="write harvest metrics to this Prometheus \
+                        textfile")
+
+
+def enableFromArgs(job, args):
+    """Start recording metrics for job if args ask for them."""
+    if args.metrics or args.prom:
+        enable(job, args.metrics, args.prom)
+
+
+def recordRequest(entry):
+    if recorder:
+        recorder.request(entry)
+
+
+def recordPage(entry):
+    """Record a processed page: its records and seconds spent per stage."""
+    if recorder:
+        recorder.page(entry)
+
+
+def finish():
+    """Print the summary and write out the Prometheus textfile."""
+    global recorder
+    if recorder:
+        print("\n" + recorder.summary())
+        recorder.close()
+        recorder = None
@@ -1,71 +1,88 @@
 """Harvest Metadata from an OAI-PMH Feed."""
 from __future__ import unicode_literals
 import requests
-import zlib
+import harvestArchive
+import harvestMetrics
+import harvestOutput
+import harvestTransport
+import harvestWorkers
 import time
 import re
-import xml.dom.pulldom
-import xml.dom.minidom
-import codecs
-from argparse import ArgumentParser
-from builtins import chr
-
-nDataBytes = 0
-nRawBytes = 0
-oaistart = """<?xml version="1.0" encoding="UTF-8"?><OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.openarchives.org/OAI/2.0/ http://www.openarchives.org/OAI/2.0/OAI-PMH.xsd"> <responseDate>2015-10-11T00:35:52Z</responseDate> <ListRecords>\n"""
-oaiend = """\n</ListRecords></OAI-PMH>\n"""
-
+import copy
+import importlib
+import json
+import os
+import shutil
+import sys
+import threading
+from datetime import datetime, timedelta
+from argparse import ArgumentParser, Namespace
+from queue import Queue
+from urllib.parse import quote
+from xml.sax.saxutils import unescape
+from lxml import etree
 
-def getFile(link, command, sleepTime=0):
-    """This generates the OAI-PMH link and retrieves the XML data over HTTP."""
-    time.sleep(sleepTime)
+oaistart = """<?xml version="1.0" encoding="UTF-8"?><OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.openarchives.org/OAI/2.0/ http://www.openarchives.org/OAI/2.0/OAI-PMH.xsd"> <responseDate>%s</responseDate> <ListRecords>\n"""
+oaiend = """\n</ListRecords></OAI-PMH>\n"""
+OAI_NS = "{http://www.openarchives.org/OAI/2.0/}"
+CHUNK_SIZE = 64 * 1024
+# Characters Illegal in XML, from
+# http://boodebr.org/main/python/all-about-python-and-unicode#UNI_XML, as
+# UTF-8 Bytes (Surrogates are Encoded as \xed[\xa0-\xbf]), and the Partial
+# Sequences a Chunk Could End with.
+RE_XML_IL_BYTES = re.compile(b'[\x00-\x08\x0b\x0c\x0e-\x1f]|\xef\xbf[\xbe\xbf]|'
+                             b'\xed[\xa0-\xbf][\x80-\xbf]')
+RE_XML_IL_TAIL = re.compile(b'(\xef\xbf?|\xed[\xa0-\xbf]?)$')
+replacedChars = {'count': 0}
+replacedLock = threading.Lock()
+TOKEN_RE = re.compile(b'<resumptionToken[^>]*>([^<]*)</resumptionToken>')
+PAGE_END_RE = re.compile(br'</(?:[\w.-]+:)?OAI-PMH>\s*$')
+# harvestArchive.PageArchive Every Page is Saved to, if Any.
+pageArchive = None
+# Analysis Scripts (analysis/<name>_analysis.py) that Read OAI-PMH Records.
+ANALYSIS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            os.pardir, 'analysis')
+ANALYSES = ('oaidc', 'mods', 'oaimods', 'dim')
 
-    # Set URL with OAI-PMH Command for Retrieval
-    remoteAddr = link + '?verb=%s' % command
-    print("\t getFile ... %s" % remoteAddr[-90:])
 
-    # Handle HTTP Response (Including Common Errors) from OAI-PMH Endpoint
+def checkResponse(link, remoteAddr):
+    """Request remoteAddr, exiting with a message if it fails for good."""
     try:
-        resp = requests.get(remoteAddr)
-        if resp.status_code != 200 and resp.status_code != 301:
-            resp.raise_for_status()
-        elif resp.status_code == 301:
-            print("%s redirected to %s ." % remoteAddr, resp.url)
-            return(getFile(resp.url, command))
-        elif '/xml' not in resp.headers.get('content-type'):
+        resp = harvestTransport.get(remoteAddr, stream=True)
+        resp.raise_for_status()
+        if '/xml' not in resp.headers.get('content-type', ''):
             print("ERROR: content-type=%s" % (resp.headers.get('content-type')))
+            harvestTransport.discard(resp)
             exit()
-        else:
-            remoteData = resp.text
     except requests.HTTPError as exValue:
+        harvestTransport.discard(exValue.response)
         status_code = exValue.response.status_code
         if status_code == 503:
-            retryWait = int(resp.headers.get("Retry-After", "-1"))
-            if retryWait < 0:
-                print("OAI-PMH Service %s Unavailable (Status 503)." % link)
-                exit()
-            else:
-                print('Waiting %d seconds' % retryWait)
-                return(getFile(link, command, retryWait))
+            print("OAI-PMH Service %s Unavailable (Status 503)." % link)
         elif status_code == 404:
             print("404 Not Found Error with OAI-PMH URL: %s" % remoteAddr)
-            exit()
         else:
             print(exValue)
-            exit()
-    return(remoteData.encode('utf8'))
+        exit()
+    except harvestTransport.HarvestError as exValue:
+        print(exValue)
+        exit()
+    return(resp)
 
 
-def zipRemoteData(remoteData):
-    # Count Bytes for Output Report, Compress Where Able for Efficiency.
-    global nRawBytes, nDataBytes
-    nRawBytes += len(remoteData)
-    try:
-        remoteData = zlib.decompressobj().decompress(remoteData)
-    except:
-        pass
-    nDataBytes += len(remoteData)
-    return(remoteData)
+def getFile(link, command, sleepTime=0):
+    """This generates the OAI-PMH link and retrieves the XML data over HTTP."""
+    time.sleep(sleepTime)
+
+    # Set URL with OAI-PMH Command for Retrieval
+    remoteAddr = link + '?verb=%s' % command
+    print("\t getFile ... %s" % remoteAddr[-90:])
+
+    # Handle HTTP Response (Including Common Errors) from OAI-PMH Endpoint.
+    # Transient Errors are Already Retried by the Transport.
+    resp = checkResponse(link, remoteAddr)
+    harvestTransport.readBody(resp)
+    return(resp.text.encode('utf8'))
 
 
 def checkOAIErrors(remoteData):
@@ -90,48 +107,880 @@ def generateOAIopts(args, verbOpts=''):
     return(verbOpts)
 
 
-def handleEncodingErrors(inputFile):
-    # Handle OAI-PMH XML Encoding Errors
-    # from http://boodebr.org/main/python/all-about-python-and-unicode#UNI_XML
-    RE_XML_IL = u'([\u0000-\u0008\u000b-\u000c\u000e-\u001f\ufffe-\uffff])' + \
-                u'|' + \
-                u'([%s-%s][^%s-%s])|([^%s-%s][%s-%s])|([%s-%s]$)|(^[%s-%s])' %\
-                (chr(0xd800), chr(0xdbff), chr(0xdc00),
-                 chr(0xdfff), chr(0xd800), chr(0xdbff),
-                 chr(0xdc00), chr(0xdfff), chr(0xd800),
-                 chr(0xdbff), chr(0xdc00), chr(0xdfff))
-    outputFile = re.sub(RE_XML_IL, u"?", inputFile.decode('utf-8'))
-    return(outputFile)
+class Sanitizer(object):
+    """Replace characters that are illegal in XML with '?' in a stream of
+       UTF-8 byte chunks, counting the replacements. Bytes that might be the
+       start of an illegal sequence split across chunks are held back until
+       the next chunk or flush()."""
+    def __init__(self):
+        self.replaced = 0
+        self.held = b''
+
+    def feed(self, chunk):
+        data = self.held + chunk
+        tail = RE_XML_IL_TAIL.search(data)
+        if tail:
+            self.held = data[tail.start():]
+            data = data[:tail.start()]
+        else:
+            self.held = b''
+        return(self.clean(data))
 
+    def flush(self):
+        data, self.held = self.held, b''
+        return(self.clean(data))
 
-def writeHarvest(link, data, ofile):
-    recordCount = 0
-    while data:
-        # I need a better way to handle python 2/3 interop here, but not finding it.
+    def clean(self, data):
+        # Almost every chunk is clean, so look before substituting.
+        if not RE_XML_IL_BYTES.search(data):
+            return(data)
+        data, count = RE_XML_IL_BYTES.subn(b'?', data)
+        self.replaced += count
+        return(data)
+
+
+def getResponse(link, command, sleepTime=0):
+    """Request an OAI-PMH page, returning the response with an unread body."""
+    time.sleep(sleepTime)
+
+    # Set URL with OAI-PMH Command for Retrieval
+    remoteAddr = link + '?verb=%s' % command
+    print("\t getResponse ... %s" % remoteAddr[-90:])
+
+    # Handle HTTP Response (Including Common Errors) from OAI-PMH Endpoint.
+    # Transient Errors are Already Retried by the Transport.
+    return(checkResponse(link, remoteAddr))
+
+
+class IncompletePage(requests.RequestException):
+    """A page whose body ended before its OAI-PMH document did."""
+
+
+def getPage(link, command):
+    """Request an OAI-PMH page and read its whole body, requesting it again
+       if the connection drops part way through the body."""
+    attempt = 1
+    while True:
+        resp = getResponse(link, command)
         try:
-            events = xml.dom.pulldom.parseString(data.encode('utf-8'))
-            for (event, node) in events:
-                if event == "START_ELEMENT" and node.tagName == 'record':
-                    events.expandNode(node)
-                    node.writexml(ofile)
-                    recordCount += 1
-        except TypeError as e:
-            events = xml.dom.pulldom.parseString(data)
-            for (event, node) in events:
-                if event == "START_ELEMENT" and node.tagName == 'record':
-                    events.expandNode(node)
-                    node.writexml(ofile)
-                    recordCount += 1
-        more = re.search('<resumptionToken[^>]*>(.*)</resumptionToken>', data)
-        if not more:
+            data = harvestTransport.readBody(resp)
+            if not PAGE_END_RE.search(data[-256:]):
+                raise IncompletePage("%s ended before </OAI-PMH>" % command)
+            if pageArchive:
+                pageArchive.write(link + '?verb=' + command, command, data)
+            return(data)
+        except requests.RequestException as exValue:
+            if attempt >= harvestTransport.MAX_ATTEMPTS:
+                raise
+            print("Page cut off (%s), requesting it again" % exValue)
+            time.sleep(harvestTransport.backoff(attempt))
+            attempt += 1
+
+
+class RecordWriter(object):
+    """Write harvested <record> elements to a binary output file. A
+       compressed file can't be rolled back to an earlier position."""
+    def __init__(self, ofile, compressed=False):
+        self.ofile = ofile
+        self.compressed = compressed
+        self.recordCount = 0
+
+    def start(self):
+        responseDate = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+        self.ofile.write((oaistart % responseDate).encode('utf-8'))
+
+    def write(self, elem):
+        self.ofile.write(etree.tostring(elem, encoding='utf-8',
+                                        with_tail=False))
+        self.recordCount += 1
+
+    def writeBytes(self, data):
+        """Write an already serialized <record>."""
+        self.ofile.write(data)
+        self.recordCount += 1
+
+    def mark(self):
+        """Remember the current position, to roll a failed page back to."""
+        if self.compressed:
+            return(None)
+        self.ofile.flush()
+        return((self.ofile.tell(), self.recordCount))
+
+    def rollback(self, mark):
+        self.ofile.seek(mark[0])
+        self.ofile.truncate()
+        self.recordCount = mark[1]
+
+    def resumable(self):
+        """Whether a checkpointed offset can be truncated back to."""
+        return(not self.compressed)
+
+    def close(self):
+        self.ofile.write(oaiend.encode('utf-8'))
+        self.ofile.close()
+
+
+class ShardedRecordWriter(RecordWriter):
+    """RecordWriter that starts a new, complete OAI-PMH file every maxRecords
+       records and/or maxBytes bytes (harvest.xml -> harvest.00000.xml, ...),
+       and lists the shards in harvest.manifest.json when closed."""
+    def __init__(self, fname, maxRecords=None, maxBytes=None):
+        RecordWriter.__init__(self, None,
+                              harvestOutput.compressionFor(fname) is not None)
+        self.root, self.ext = harvestOutput.splitFilename(fname)
+        self.maxRecords = maxRecords
+        self.maxBytes = maxBytes
+        self.shards = []
+
+    def shardFilename(self, n):
+        return('%s.%05d%s' % (self.root, n, self.ext))
+
+    def start(self):
+        fname = self.shardFilename(len(self.shards))
+        self.ofile = harvestOutput.openOutput(fname)
+        self.shards.append({'file': os.path.basename(fname), 'records': 0,
+                            'bytes': 0, 'from': None, 'until': None})
+        RecordWriter.start(self)
+
+    def write(self, elem):
+        shard = self.shards[-1]
+        if shard['records'] and (
+                (self.maxRecords and shard['records'] >= self.maxRecords) or
+                (self.maxBytes and shard['bytes'] >= self.maxBytes)):
+            RecordWriter.close(self)
+            self.start()
+            shard = self.shards[-1]
+        data = etree.tostring(elem, encoding='utf-8', with_tail=False)
+        self.ofile.write(data)
+        self.recordCount += 1
+        shard['records'] += 1
+        shard['bytes'] += len(data)
+
+        # Keep the Datestamp Range so a Bad Shard can be Re-harvested Alone.
+        datestamp = elem.findtext('%sheader/%sdatestamp' % (OAI_NS, OAI_NS))
+        if datestamp:
+            if shard['from'] is None or datestamp < shard['from']:
+                shard['from'] = datestamp
+            if shard['until'] is None or datestamp > shard['until']:
+                shard['until'] = datestamp
+
+    def mark(self):
+        if self.compressed:
+            return(None)
+        self.ofile.flush()
+        return((len(self.shards), self.ofile.tell(), self.recordCount,
+                dict(self.shards[-1])))
+
+    def rollback(self, mark):
+        shardCount, offset, recordCount, shard = mark
+        while len(self.shards) > shardCount:
+            # Drop Shards Started After the Mark and Reopen the One Before.
+            self.ofile.close()
+            os.remove(self.shardFilename(len(self.shards) - 1))
+            self.shards.pop()
+            self.ofile = open(self.shardFilename(len(self.shards) - 1), 'r+b')
+        self.ofile.seek(offset)
+        self.ofile.truncate()
+        self.shards[-1] = shard
+        self.recordCount = recordCount
+
+    def resumable(self):
+        return(False)
+
+    def close(self):
+        RecordWriter.close(self)
+        manifest = {'recordCount': self.recordCount, 'shards': self.shards}
+        with open(self.root + '.manifest.json', 'w') as mfile:
+            json.dump(manifest, mfile, indent=2)
+
+
+def recordIdentifier(elem):
+    """Return the OAI identifier from a <record>'s header."""
+    return(elem.findtext('%sheader/%sidentifier' % (OAI_NS, OAI_NS)))
+
+
+def openWriter(fname, writerClass=RecordWriter):
+    """Open fname for a writer, compressed if its extension says so."""
+    compressed = harvestOutput.compressionFor(fname) is not None
+    return(writerClass(harvestOutput.openOutput(fname), compressed))
+
+
+class DedupRecordWriter(RecordWriter):
+    """RecordWriter shared between harvest threads that skips any record
+       whose OAI identifier has already been written."""
+    def __init__(self, ofile, compressed=False):
+        RecordWriter.__init__(self, ofile, compressed)
+        self.lock = threading.Lock()
+        self.seen = set()
+        self.duplicateCount = 0
+
+    def write(self, elem):
+        identifier = recordIdentifier(elem)
+        with self.lock:
+            if identifier in self.seen:
+                self.duplicateCount += 1
+                return(False)
+            self.seen.add(identifier)
+            RecordWriter.write(self, elem)
+        return(True)
+
+    def mark(self):
+        # Other Threads Write Between a Mark and a Rollback, so Pages are
+        # Only Handed Over Whole.
+        return(None)
+
+
+class SetWriter(object):
+    """Per-set view of a shared DedupRecordWriter, counting only the records
+       this set actually added."""
+    def __init__(self, writer):
+        self.writer = writer
+        self.recordCount = 0
+
+    def write(self, elem):
+        if self.writer.write(elem):
+            self.recordCount += 1
+
+
+def loadAnalysis(name):
+    """Import analysis/<name>_analysis.py for its Record and report methods."""
+    if ANALYSIS_DIR not in sys.path:
+        sys.path.append(ANALYSIS_DIR)
+    return(importlib.import_module(name + '_analysis'))
+
+
+class AnalysisWriter(object):
+    """Writer that runs every record harvested through an analysis module's
+       Record.get_stats and collect_stats, for its field report, and then
+       hands it on to writer, if there is one. With dedup, records whose
+       identifier was already seen are skipped, as are any writer skips."""
+    def __init__(self, module, writer=None, dedup=False):
+        self.module = module
+        self.writer = writer
+        self.seen = set() if dedup else None
+        self.args = Namespace(element=None, xpath=None, stats=True,
+                              present=False, id=False, dump=False)
+        self.stats = {'record_count': 0, 'field_info': {}}
+        self.lock = threading.Lock()
+        self.recordCount = 0
+        self.duplicateCount = 0
+
+    def start(self):
+        if self.writer:
+            self.writer.start()
+
+    def write(self, elem):
+        with self.lock:
+            if self.seen is not None:
+                identifier = recordIdentifier(elem)
+                if identifier in self.seen:
+                    self.duplicateCount += 1
+                    return(False)
+                self.seen.add(identifier)
+            if self.writer and self.writer.write(elem) is False:
+                return(False)
+            self.recordCount += 1
+            record = self.module.Record(elem, self.args)
+            if record.get_record_status() != 'deleted':
+                self.module.collect_stats(self.stats, record.get_stats())
+        return(True)
+
+    def mark(self):
+        # The Stats Go Back with the File, so a Retried Page Counts Once.
+        inner = self.writer.mark() if self.writer else ()
+        if inner is None:
+            return(None)
+        return((inner, copy.deepcopy(self.stats), self.recordCount,
+                set(self.seen) if self.seen is not None else None))
+
+    def rollback(self, mark):
+        inner, self.stats, self.recordCount, self.seen = mark
+        if self.writer:
+            self.writer.rollback(inner)
+
+    def resumable(self):
+        # The Stats of the Pages Before a Checkpoint Aren't Saved with it.
+        return(False)
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+
+    def report(self):
+        """Print the analysis module's field report."""
+        if not self.stats['record_count']:
+            print("No records to analyze")
+            return
+        self.module.pretty_print_stats(
+            self.module.create_stats_averages(self.stats))
+
+
+def processPage(chunks, writer, label=None):
+    """Incrementally parse one ListRecords page from an iterable of byte
+       chunks, handing each <record> to writer. Time spent sanitizing,
+       parsing and writing goes to harvestMetrics under label. Returns the
+       resumptionToken, or None on the last page. Raises IncompletePage if
+       the chunks end before the OAI-PMH document does, as recover mode
+       would otherwise close it and give back the records before the cut."""
+    parser = etree.XMLPullParser(events=('end',), recover=True,
+                                 huge_tree=True)
+    sanitizer = Sanitizer()
+    state = {'token': None, 'records': 0, 'complete': False}
+    timer = {'sanitize': 0.0, 'parse': 0.0, 'write': 0.0}
+
+    def handleEvents():
+        for event, elem in parser.read_events():
+            if elem.tag == OAI_NS + 'record':
+                started = time.time()
+                writer.write(elem)
+                timer['write'] += time.time() - started
+                state['records'] += 1
+                # Drop the written record and its predecessors to keep the
+                # page tree from growing.
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+            elif elem.tag == OAI_NS + 'resumptionToken':
+                state['token'] = elem.text or None
+            elif elem.tag == OAI_NS + 'OAI-PMH':
+                state['complete'] = True
+            elif elem.tag == OAI_NS + 'error':
+                if elem.get('code') == 'noRecordsMatch':
+                    # An empty result (e.g. a quiet date window) isn't fatal.
+                    continue
+                print("OAIERROR: code=%s '%s'" % (elem.get('code'), elem.text))
+                exit()
+
+    def feed(chunk):
+        started = time.time()
+        chunk = sanitizer.feed(chunk) if chunk is not None else sanitizer.flush()
+        sanitized = time.time()
+        parser.feed(chunk)
+        handleEvents()
+        timer['sanitize'] += sanitized - started
+        timer['parse'] += time.time() - sanitized
+
+    for chunk in chunks:
+        feed(chunk)
+    feed(None)
+    # Closing Ends Any Elements Still Open, so Check the Page Ended First.
+    complete = state['complete']
+    started = time.time()
+    parser.close()
+    handleEvents()
+    if not complete:
+        raise IncompletePage("%s ended before </OAI-PMH>" % (label or 'page'))
+    timer['parse'] += time.time() - started - timer['write']
+    with replacedLock:
+        replacedChars['count'] += sanitizer.replaced
+    harvestMetrics.recordPage(dict(timer, records=state['records'],
+                                   label=label))
+    return(state['token'])
+
+
+def streamPage(link, command, writer, mark):
+    """Write the records of a page to writer as its body streams in, rolling
+       writer back to mark and requesting the page again if it is cut off.
+       Returns the page's resumptionToken."""
+    attempt = 1
+    while True:
+        resp = getResponse(link, command)
+        chunks = harvestTransport.iterBody(resp, CHUNK_SIZE)
+        if pageArchive:
+            chunks = pageArchive.tee(chunks, link + '?verb=' + command,
+                                     command)
+        try:
+            return(processPage(chunks, writer, command))
+        except requests.RequestException as exValue:
+            if attempt >= harvestTransport.MAX_ATTEMPTS:
+                raise
+            writer.rollback(mark)
+            print("Page cut off (%s), requesting it again" % exValue)
+            time.sleep(harvestTransport.backoff(attempt))
+            attempt += 1
+
+
+def harvestRecords(link, command, writer, onPage=None):
+    """Stream every page of a ListRecords request and its resumption chain
+       into writer. onPage, if given, is called with the next page's command
+       (None after the last page) once each page is written. Returns the
+       number of records written."""
+    while command:
+        # Records are Written as the Page Streams in, so a Page Cut off Part
+        # Way is Rolled Back and Requested Again. A Writer that Can't Roll
+        # Back Gets Each Page Only Once it Has Been Read in Full.
+        mark = writer.mark() if hasattr(writer, 'mark') else None
+        if mark is None:
+            token = processPage([getPage(link, command)], writer, command)
+        else:
+            token = streamPage(link, command, writer, mark)
+        if token:
+            command = "ListRecords&resumptionToken=%s" % token
+        else:
+            command = None
+        if onPage:
+            onPage(command)
+    return(writer.recordCount)
+
+
+def fetchPages(link, command, pages):
+    """Fetch stage of a pipelined harvest: queue each page body and request
+       the next page as soon as its resumptionToken has been read."""
+    try:
+        while command:
+            data = getPage(link, command)
+            more = TOKEN_RE.search(data)
+            if more and more.group(1).strip():
+                token = unescape(more.group(1).decode('utf-8').strip())
+                nextCommand = "ListRecords&resumptionToken=%s" % token
+            else:
+                nextCommand = None
+            pages.put((data, command, nextCommand))
+            command = nextCommand
+    except BaseException as exValue:
+        # Hand failures (including exit()) to the writer to re-raise.
+        pages.put(exValue)
+        return
+    pages.put(None)
+
+
+def harvestPipelined(link, command, writer, prefetch, onPage=None):
+    """Harvest like harvestRecords, but fetch up to prefetch pages ahead of
+       the page currently being parsed and written."""
+    pages = Queue(maxsize=prefetch)
+    fetcher = threading.Thread(target=fetchPages, args=(link, command, pages))
+    fetcher.daemon = True
+    fetcher.start()
+    while True:
+        page = pages.get()
+        if page is None:
             break
+        elif isinstance(page, BaseException):
+            raise page
+        data, command, nextCommand = page
+        processPage([data], writer, command)
+        if onPage:
+            onPage(nextCommand)
+    fetcher.join()
+    return(writer.recordCount)
+
+
+def harvestChain(args, command, writer, onPage=None):
+    """Harvest one ListRecords chain, pipelined if args.prefetch is set."""
+    if args.prefetch > 0:
+        return(harvestPipelined(args.link, command, writer, args.prefetch,
+                                onPage))
+    return(harvestRecords(args.link, command, writer, onPage))
+
+
+def saveCheckpoint(fname, checkpoint):
+    """Write the resume point for a harvest next to its output file."""
+    with open(fname + '.checkpoint', 'w') as cfile:
+        json.dump(checkpoint, cfile)
+
+
+def loadCheckpoint(fname):
+    with open(fname + '.checkpoint') as cfile:
+        return(json.load(cfile))
+
+
+def checkpointer(fname, link, writer):
+    """Return an onPage callback that checkpoints the harvest after every
+       page: the next command to request, records written, and the output
+       offset to truncate back to."""
+    def onPage(command):
+        writer.ofile.flush()
+        saveCheckpoint(fname, {'link': link,
+                               'command': command,
+                               'recordCount': writer.recordCount,
+                               'offset': writer.ofile.tell()})
+    return(onPage)
+
+
+def resumeWriter(fname, checkpoint):
+    """Reopen a checkpointed harvest, dropping anything written after the
+       last checkpointed page, and return its writer."""
+    ofile = open(fname, 'r+b')
+    ofile.seek(checkpoint['offset'])
+    ofile.truncate()
+    writer = RecordWriter(ofile)
+    writer.recordCount = checkpoint['recordCount']
+    return(writer)
+
+
+def listSets(link):
+    """Return the setSpec of every set the repository reports in ListSets."""
+    sets = []
+    command = 'ListSets'
+    while command:
+        root = etree.fromstring(getPage(link, command))
+        for err in root.iter(OAI_NS + 'error'):
+            print("OAIERROR: code=%s '%s'" % (err.get('code'), err.text))
+            exit()
+        for setSpec in root.iter(OAI_NS + 'setSpec'):
+            sets.append(setSpec.text)
+        token = root.findtext('.//%sresumptionToken' % OAI_NS)
+        if token:
+            command = "ListSets&resumptionToken=%s" % token
+        else:
+            command = None
+    return(sets)
+
+
+def setFilename(fname, setSpec):
+    """Name the output file for one set, e.g. harvest.xml -> harvest.col_1.xml"""
+    root, ext = harvestOutput.splitFilename(fname)
+    return('%s.%s%s' % (root, re.sub(r'[^\w.-]', '_', setSpec), ext))
+
+
+def harvestSets(args, sets):
+    """Harvest several sets at the same time, either merged into one output
+       file without duplicate records or into one file per set. Exits with
+       status 1 if any set fails."""
+    setCounts = {}
+
+    if args.splitSets:
+        def harvestSet(setSpec):
+            setArgs = Namespace(**vars(args))
+            setArgs.setName = setSpec
+            writer = openWriter(setFilename(args.fname, setSpec))
+            writer.start()
+            setCounts[setSpec] = harvestChain(
+                setArgs, 'ListRecords' + generateOAIopts(setArgs), writer)
+            writer.close()
+        failures = harvestWorkers.runWorkers(harvestSet, sets, args.workers)
+    else:
+        writer = openWriter(args.fname, DedupRecordWriter)
+        writer.start()
+
+        def harvestSet(setSpec):
+            setArgs = Namespace(**vars(args))
+            setArgs.setName = setSpec
+            setCounts[setSpec] = harvestChain(
+                setArgs, 'ListRecords' + generateOAIopts(setArgs),
+                SetWriter(writer))
+        failures = harvestWorkers.runWorkers(harvestSet, sets, args.workers)
+        writer.close()
+        print("Skipped %d records already harvested from another set"
+              % writer.duplicateCount)
+
+    for setSpec in sets:
+        if setSpec in failures:
+            print("%s: FAILED" % setSpec)
         else:
-            data = getFile(link, "ListRecords&resumptionToken=%s" % more.group(1))
-            data = handleEncodingErrors(data)
-    return(recordCount)
+            print("%s: %d records" % (setSpec, setCounts[setSpec]))
+    if failures:
+        # The File(s) are Closed, but a Failed Set May be in Them in Part.
+        print("%d of %d sets failed to harvest" % (len(failures), len(sets)))
+        exit(1)
+    return(sum(setCounts.values()))
+
+
+def identify(link):
+    """Return the repository's earliestDatestamp from Identify."""
+    root = etree.fromstring(getPage(link, 'Identify'))
+    return(root.findtext('.//%searliestDatestamp' % OAI_NS))
+
+
+def dateWindows(fromDate, untilDate, windows):
+    """Split fromDate..untilDate (YYYY-MM-DD, inclusive) into up to windows
+       non-overlapping (from, until) pairs of whole days, in date order."""
+    start = datetime.strptime(fromDate[:10], '%Y-%m-%d')
+    end = datetime.strptime(untilDate[:10], '%Y-%m-%d')
+    days = (end - start).days + 1
+    windows = max(1, min(windows, days))
+    out = []
+    for n in range(windows):
+        first = start + timedelta(days=days * n // windows)
+        last = start + timedelta(days=days * (n + 1) // windows - 1)
+        out.append((first.strftime('%Y-%m-%d'), last.strftime('%Y-%m-%d')))
+    return(out)
+
+
+def harvestWindows(args):
+    """Harvest a date range as several from/until windows at the same time,
+       then stitch them into the output file in date order. Finished windows
+       are kept on disk until the stitch, so rerunning the same command after
+       a failure only harvests the windows that failed."""
+    fromDate = args.fromDate or identify(args.link)
+    untilDate = args.until or datetime.utcnow().strftime('%Y-%m-%d')
+    windows = dateWindows(fromDate, untilDate, args.windows)
+    manifest = args.fname + '.windows.json'
+    lock = threading.Lock()
+    counts = {}
+    if os.path.exists(manifest):
+        with open(manifest) as mfile:
+            counts = json.load(mfile)
+
+    def windowFilename(window):
+        return('%s.%s_%s' % (args.fname, window[0], window[1]))
+
+    def harvestWindow(window):
+        key = '%s_%s' % window
+        if key in counts and os.path.exists(windowFilename(window)):
+            print("Window %s to %s already harvested" % window)
+            return
+        windowArgs = Namespace(**vars(args))
+        windowArgs.fromDate, windowArgs.until = window
+        ofile = open(windowFilename(window) + '.part', 'wb')
+        writer = RecordWriter(ofile)
+        harvestChain(windowArgs, 'ListRecords' + generateOAIopts(windowArgs),
+                     writer)
+        ofile.close()
+        os.rename(windowFilename(window) + '.part', windowFilename(window))
+        with lock:
+            counts[key] = writer.recordCount
+            with open(manifest, 'w') as mfile:
+                json.dump(counts, mfile)
+
+    print("Harvesting %s to %s in %d windows" % (windows[0][0], windows[-1][1],
+                                                 len(windows)))
+    failures = harvestWorkers.runWorkers(harvestWindow, windows, args.workers)
+    if failures:
+        print("%d of %d windows failed; rerun the same command to retry them"
+              % (len(failures), len(windows)))
+        exit()
+
+    # Stitch Windows Together in Date Order
+    writer = openWriter(args.fname)
+    writer.start()
+    for window in windows:
+        with open(windowFilename(window), 'rb') as wfile:
+            shutil.copyfileobj(wfile, writer.ofile)
+        writer.recordCount += counts['%s_%s' % window]
+    writer.close()
+    for window in windows:
+        os.remove(windowFilename(window))
+    os.remove(manifest)
+    return(writer.recordCount)
+
+
+class UpdateCollector(object):
+    """Writer that keeps harvested records in memory, keyed by identifier,
+       for merging into an existing harvest file."""
+    def __init__(self):
+        self.records = {}
+        self.recordCount = 0
+        self.lock = threading.Lock()
+
+    def write(self, elem):
+        data = etree.tostring(elem, encoding='utf-8', with_tail=False)
+        with self.lock:
+            self.records[recordIdentifier(elem)] = data
+            self.recordCount += 1
+
+    def mark(self):
+        return(self.recordCount)
+
+    def rollback(self, mark):
+        # Records from the retried page overwrite their earlier copies.
+        self.recordCount = mark
+
+
+def iterRecords(fname):
+    """Iterate over the <record> elements of a harvest file, clearing each
+       one after it has been handled."""
+    for event, elem in etree.iterparse(harvestOutput.openInput(fname),
+                                       events=('end',),
+                                       tag=OAI_NS + 'record', huge_tree=True):
+        yield elem
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
+def lastHarvestDate(fname):
+    """Return the newest record datestamp in a harvest file, falling back on
+       its responseDate when it has no records."""
+    newest = None
+    for elem in iterRecords(fname):
+        datestamp = elem.findtext('%sheader/%sdatestamp' % (OAI_NS, OAI_NS))
+        if datestamp and (newest is None or datestamp > newest):
+            newest = datestamp
+    if newest is None:
+        root = etree.parse(harvestOutput.openInput(fname)).getroot()
+        newest = root.findtext(OAI_NS + 'responseDate')
+    return(newest)
+
+
+def mergeHarvest(fname, updates):
+    """Upsert harvested records into an existing harvest file by identifier.
+       Updated and deleted records replace the old copy in place, new ones
+       are added at the end. Returns (replaced, added, deleted) counts."""
+    replaced = 0
+    deleted = 0
+    for data in updates.values():
+        if b'status="deleted"' in data.split(b'</header>', 1)[0]:
+            deleted += 1
+    writer = RecordWriter(harvestOutput.openOutput(
+        fname + '.merge', harvestOutput.compressionFor(fname)), True)
+    writer.start()
+    for elem in iterRecords(fname):
+        identifier = recordIdentifier(elem)
+        if identifier in updates:
+            writer.writeBytes(updates.pop(identifier))
+            replaced += 1
+        else:
+            writer.write(elem)
+    for identifier in updates:
+        writer.writeBytes(updates[identifier])
+    writer.close()
+    shutil.move(fname + '.merge', fname)
+    return(replaced, len(updates), deleted)
+
+
+def harvestIncremental(args):
+    """Harvest only what changed since the last harvest into args.fname and
+       merge it into that file."""
+    if not args.fromDate:
+        args.fromDate = lastHarvestDate(args.fname)[:10]
+    verbOpts = generateOAIopts(args)
+    print("Harvesting changes since %s" % args.fromDate)
+    collector = UpdateCollector()
+    harvestChain(args, 'ListRecords' + verbOpts, collector)
+    if not collector.records:
+        # Nothing Changed, so Leave the Harvest File as it is.
+        print("No records changed since %s" % args.fromDate)
+        return(0)
+    replaced, added, deleted = mergeHarvest(args.fname, collector.records)
+    print("Replaced %d records and added %d (%d marked deleted)"
+          % (replaced, added, deleted))
+    return(collector.recordCount)
+
+
+def harvestFromArchive(args, writer=None):
+    """Rebuild args.fname (or feed writer) from the ListRecords pages in
+       args.fromArchive, without the network: every chain archived is
+       followed through its resumptionTokens, newest harvest first, and
+       records already written (overlapping sets, or the older copy of a
+       record an incremental harvest updated or deleted) should be skipped
+       by the writer."""
+    index = harvestArchive.indexArchive(args.fromArchive)
+    starts = sorted((url for url in index if '?verb=ListRecords' in url
+                     and 'resumptionToken=' not in url),
+                    key=index.get, reverse=True)
+    print("Rebuilding from %d pages in %s (%d ListRecords requests)"
+          % (len(index), args.fromArchive, len(starts)))
+    if writer is None:
+        writer = openWriter(args.fname, DedupRecordWriter)
+    writer.start()
+    with open(args.fromArchive, 'rb') as afile:
+        for start in starts:
+            link, command = start.split('?verb=', 1)
+            while command:
+                url = link + '?verb=' + command
+                if url not in index:
+                    print("No page for %s in the archive, that harvest \
+stopped here" % url)
+                    break
+                data = harvestArchive.readPage(afile, index[url])
+                token = processPage([data], writer, command)
+                if token:
+                    command = "ListRecords&resumptionToken=%s" % token
+                else:
+                    command = None
+    writer.close()
+    if writer.duplicateCount:
+        print("Skipped %d records already written from another set or a \
+newer harvest" % writer.duplicateCount)
+    return(writer.recordCount)
+
+
+def headerState(header):
+    """The (datestamp, deleted) of a record header, to spot changes by."""
+    return((header.findtext(OAI_NS + 'datestamp'),
+            header.get('status') == 'deleted'))
+
+
+def harvestIndex(fname):
+    """Map each OAI identifier in a harvest file to its headerState."""
+    index = {}
+    for elem in iterRecords(fname):
+        header = elem.find(OAI_NS + 'header')
+        if header is not None:
+            index[header.findtext(OAI_NS + 'identifier')] = headerState(header)
+    return(index)
+
+
+def listIdentifiers(link, verbOpts):
+    """Yield every <header> ListIdentifiers returns, page by page."""
+    parser = etree.XMLParser(recover=True, huge_tree=True)
+    command = 'ListIdentifiers' + verbOpts
+    while command:
+        root = etree.fromstring(Sanitizer().clean(getPage(link, command)),
+                                parser)
+        for err in root.iter(OAI_NS + 'error'):
+            if err.get('code') == 'noRecordsMatch':
+                return
+            print("OAIERROR: code=%s '%s'" % (err.get('code'), err.text))
+            exit()
+        for header in list(root.iter(OAI_NS + 'header')):
+            yield header
+        token = root.findtext('.//%sresumptionToken' % OAI_NS)
+        if token and token.strip():
+            command = "ListIdentifiers&resumptionToken=%s" % token.strip()
+        else:
+            command = None
+
+
+def harvestRefetch(args):
+    """Walk ListIdentifiers, compare each header against the records already
+       in args.fname, and GetRecord only the new or changed ones, args.workers
+       at a time, merging them into that file. Deleted headers need no
+       GetRecord. For repositories whose from/until filtering can't be
+       trusted."""
+    print("Indexing the records in %s" % args.fname)
+    index = harvestIndex(args.fname)
+    collector = UpdateCollector()
+    changed = []
+    listed = 0
+    for header in listIdentifiers(args.link, generateOAIopts(args)):
+        listed += 1
+        identifier = header.findtext(OAI_NS + 'identifier')
+        state = headerState(header)
+        if index.get(identifier) == state:
+            continue
+        if state[1]:
+            record = etree.Element(OAI_NS + 'record')
+            record.append(header)
+            collector.write(record)
+        else:
+            changed.append(identifier)
+    print("%d of %d identifiers are new or changed, fetching %d records %d \
+at a time" % (len(changed) + collector.recordCount, listed, len(changed),
+              args.workers))
+
+    command = 'GetRecord&metadataPrefix=%s&identifier=%%s' % args.mdprefix
+
+    def fetchRecord(identifier):
+        processPage([getPage(args.link, command % quote(identifier, safe=''))],
+                    collector, 'GetRecord ' + identifier)
+
+    failures = harvestWorkers.runWorkers(fetchRecord, changed, args.workers)
+    replaced, added, deleted = mergeHarvest(args.fname, collector.records)
+    print("Replaced %d records and added %d (%d marked deleted)"
+          % (replaced, added, deleted))
+    if failures:
+        print("%d records could not be fetched. Rerun to try them again."
+              % len(failures))
+    return(collector.recordCount)
+
+
+def writeHarvest(link, data, ofile):
+    """Write the records of a ListRecords page, and of the rest of its
+       resumption chain, to the binary file ofile. Returns the number of
+       records written."""
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    writer = RecordWriter(ofile)
+    token = processPage([data], writer)
+    if token:
+        harvestRecords(link, "ListRecords&resumptionToken=%s" % token, writer)
+    return(writer.recordCount)
 
 
 def main():
+    global pageArchive
     parser = ArgumentParser()
     parser.add_argument("-l", "--link", dest="link", help="OAI-PMH URL",
                         default="https://ecommons.cornell.edu/dspace-oai/request")
@@ -144,40 +993,232 @@ def main():
     parser.add_argument("-m", "--mdprefix", dest="mdprefix", default="oai_dc",
                         help="use the specified metadata format")
     parser.add_argument("-s", "--setName", dest="setName",
-                        help="harvest the specified OAI-PMH set")
+                        help="harvest the specified OAI-PMH set, or a \
+                        comma-separated list of sets to harvest at once")
+    parser.add_argument("-a", "--all-sets", dest="allSets", default=False,
+                        action="store_true", help="harvest every set listed \
+                        by ListSets at the same time")
+    parser.add_argument("-w", "--workers", dest="workers", type=int,
+                        default=4, help="number of concurrent requests to \
+                        the repository when harvesting several sets, windows \
+                        or --refetch records")
+    parser.add_argument("--no-adaptive", dest="adaptive", default=True,
+                        action="store_false", help="always allow -w requests \
+                        in flight instead of adapting to the repository's \
+                        latency and 503s")
+    parser.add_argument("-n", "--windows", dest="windows", type=int,
+                        default=0, help="split the from/until range into \
+                        this many date windows and harvest them at once")
+    parser.add_argument("-r", "--resume", dest="resume", default=False,
+                        action="store_true", help="continue an interrupted \
+                        harvest into -o from its last checkpoint")
+    parser.add_argument("-i", "--incremental", dest="incremental",
+                        default=False, action="store_true", help="harvest \
+                        changes since the newest record in -o and merge them \
+                        into that file")
+    parser.add_argument("--refetch", dest="refetch", default=False,
+                        action="store_true", help="compare ListIdentifiers \
+                        against the records in -o and GetRecord only the new \
+                        or changed ones, -w at a time, merging them into -o")
+    parser.add_argument("--split-sets", dest="splitSets", default=False,
+                        action="store_true", help="write each set to its own \
+                        file instead of one deduplicated file")
+    parser.add_argument("-p", "--prefetch", dest="prefetch", type=int,
+                        default=0, help="fetch up to this many pages ahead \
+                        of the writer (pipelined harvest)")
+    harvestOutput.addArgument(parser)
+    parser.add_argument("--shard-size", dest="shardSize", type=int,
+                        help="start a new output file every this many \
+                        records, listed in a .manifest.json")
+    parser.add_argument("--shard-mb", dest="shardMB", type=float,
+                        help="start a new output file every this many MB of \
+                        records, listed in a .manifest.json")
+    parser.add_argument("--archive", dest="archive",
+                        help="also save every raw page fetched to this \
+                        archive (gzipped WARC records, added to if it exists)")
+    parser.add_argument("--from-archive", dest="fromArchive",
+                        help="rebuild -o from the pages in this archive \
+                        instead of harvesting")
+    parser.add_argument("--analyze", dest="analysis", choices=ANALYSES,
+                        help="run every record through this analysis script's \
+                        field report as it is harvested")
+    parser.add_argument("--no-file", dest="noFile", default=False,
+                        action="store_true", help="with --analyze, only \
+                        print the report and don't write -o")
+    harvestMetrics.addArguments(parser)
     args = parser.parse_args()
 
+    # Record Harvest Metrics if Asked
+    harvestMetrics.enableFromArgs('harvestOAI', args)
+
+    # Load the Analysis Script to Hand Records to as they are Harvested
+    analyzer = None
+    if args.noFile and not args.analysis:
+        parser.error("--no-file needs --analyze")
+    if args.analysis:
+        if (args.resume or args.incremental or args.refetch or args.allSets
+                or args.windows > 1 or (args.setName and ',' in args.setName)):
+            parser.error("--analyze works on a single-set harvest or \
+--from-archive")
+        analysis = loadAnalysis(args.analysis)
+
+    # Add the Extension for Compressed Output
+    args.fname = harvestOutput.prepareFilename(parser, args.fname,
+                                               args.compress)
+    if harvestOutput.compressionFor(args.fname) and args.resume:
+        parser.error("a compressed harvest can't be resumed")
+    if (args.shardSize or args.shardMB) and (
+            args.resume or args.incremental or args.refetch or args.allSets
+            or args.windows > 1
+            or (args.setName and ',' in args.setName)):
+        parser.error("sharded output is only for a plain single-set harvest")
+    if args.fromArchive and (args.resume or args.incremental or args.refetch
+                             or args.archive or args.shardSize or args.shardMB):
+        parser.error("--from-archive only rebuilds -o from its pages")
+    if args.refetch and (args.resume or args.incremental or args.allSets
+                         or args.windows > 1
+                         or (args.setName and ',' in args.setName)):
+        parser.error("--refetch updates -o from a single ListIdentifiers walk")
+    if args.incremental and (args.allSets
+                             or (args.setName and ',' in args.setName)):
+        parser.error("-i merges a single-set harvest into -o")
+    if args.resume and (args.allSets
+                        or (args.setName and ',' in args.setName)):
+        parser.error("only a single-set harvest can be resumed")
+    if args.windows > 1 and (args.resume or args.incremental):
+        parser.error("date windows can't be resumed or merged with -i; rerun \
+the same -n command to retry failed windows")
+
+    # Pick Up the Repository from the Checkpoint When Resuming
+    if args.resume:
+        try:
+            checkpoint = loadCheckpoint(args.fname)
+        except (IOError, OSError, ValueError):
+            parser.error("no usable checkpoint for %s" % args.fname)
+        args.link = checkpoint['link']
+
+    # Keep a Pooled Connection Open for Each Concurrent Request, and Let the
+    # Transport Find How Many the Repository Can Handle
+    harvestTransport.setPoolSize(args.workers)
+    if args.adaptive:
+        harvestTransport.setAdaptive(args.workers)
+
     # Check OAI-PMH URL is valid
     if not args.link.startswith('http'):
         args.link = 'http://' + args.link
 
-    # Start Harvest Process
-    print("Writing records to %s from repository %s" % (args.fname, args.link))
+    # Rebuild from Archived Pages Without the Network
+    if args.fromArchive:
+        if not os.path.exists(args.fromArchive):
+            parser.error("no archive %s" % args.fromArchive)
+        if args.analysis:
+            analyzer = AnalysisWriter(
+                analysis, None if args.noFile else openWriter(args.fname),
+                dedup=True)
+        recordCount = harvestFromArchive(args, analyzer)
+        if analyzer:
+            analyzer.report()
+        if replacedChars['count']:
+            print("Replaced %d characters not allowed in XML with '?'"
+                  % replacedChars['count'])
+        print("%s %d records" % ('Analyzed' if args.noFile else 'Wrote out',
+                                 recordCount))
+        harvestMetrics.finish()
+        return
 
-    # Generate the OAI-PMH URL with Provided Arguments
-    verbOpts = generateOAIopts(args)
-    print("Using url:%s" % args.link + '?verb=ListRecords' + verbOpts)
+    # Save Every Page Fetched if Asked
+    if args.archive:
+        pageArchive = harvestArchive.PageArchive(args.archive)
 
-    # Create Start of XML Output File
-    ofile = codecs.lookup('utf-8')[-1](open(args.fname, 'wb'))
-    ofile.write(oaistart)
+    # Start Harvest Process
+    if args.noFile:
+        print("Analyzing records from repository %s" % args.link)
+    else:
+        print("Writing records to %s from repository %s"
+              % (args.fname, args.link))
 
-    # Grab & Clean XML Records from OAI Feed
-    remoteData = getFile(args.link, 'ListRecords' + verbOpts)
-    data = zipRemoteData(remoteData)
-    data = checkOAIErrors(data)
-    dataClean = handleEncodingErrors(data)
+    # Harvest Several Sets or Date Windows at Once if Asked
+    if args.windows > 1:
+        if args.allSets or (args.setName and ',' in args.setName):
+            parser.error("date windows can only be used with a single set")
+        recordCount = harvestWindows(args)
+    elif args.allSets or (args.setName and ',' in args.setName):
+        if args.allSets:
+            sets = listSets(args.link)
+        else:
+            sets = [setSpec.strip() for setSpec in args.setName.split(',')]
+        print("Harvesting %d sets, %d at a time" % (len(sets), args.workers))
+        recordCount = harvestSets(args, sets)
+    elif args.incremental:
+        if not os.path.exists(args.fname):
+            parser.error("nothing to update, %s does not exist" % args.fname)
+        recordCount = harvestIncremental(args)
+    elif args.refetch:
+        if not os.path.exists(args.fname):
+            parser.error("nothing to compare, %s does not exist" % args.fname)
+        recordCount = harvestRefetch(args)
+    else:
+        if args.resume:
+            # Drop Anything Written After the Last Checkpointed Page
+            command = checkpoint['command']
+            writer = resumeWriter(args.fname, checkpoint)
+            print("Resuming after %d records with %s"
+                  % (writer.recordCount, command))
+        else:
+            # Generate the OAI-PMH URL with Provided Arguments
+            verbOpts = generateOAIopts(args)
+            command = 'ListRecords' + verbOpts
+            print("Using url:%s" % args.link + '?verb=' + command)
 
-    # Iterate over Records, ResumptionTokens, & Write to File
-    recordCount = writeHarvest(args.link, dataClean, ofile)
+            # Create Start of XML Output File, or of the First Shard, Passing
+            # Records Through the Analysis First
+            if args.noFile:
+                writer = None
+            elif args.shardSize or args.shardMB:
+                maxBytes = int(args.shardMB * 1024 * 1024) if args.shardMB else None
+                writer = ShardedRecordWriter(args.fname, args.shardSize,
+                                             maxBytes)
+            else:
+                writer = openWriter(args.fname)
+            if args.analysis:
+                writer = analyzer = AnalysisWriter(analysis, writer)
+            writer.start()
+
+        # Stream Records over ResumptionTokens & Write to File, Checkpointing
+        # after Every Page (Uncompressed Output Only, as Resuming Truncates
+        # the File). On Failure, Close the File so it is Well-Formed.
+        onPage = None
+        if writer.resumable():
+            onPage = checkpointer(args.fname, args.link, writer)
+            onPage(command)
+        try:
+            recordCount = harvestChain(args, command, writer, onPage)
+        except BaseException:
+            writer.close()
+            if onPage:
+                checkpoint = loadCheckpoint(args.fname)
+                print("Harvest stopped after %d records. Rerun with --resume \
+to continue from the last saved page." % checkpoint['recordCount'])
+            raise
 
-    # Finish Harvest Writer
-    ofile.write(oaiend)
-    ofile.close()
+        # Finish Harvest Writer
+        writer.close()
+        if onPage:
+            os.remove(args.fname + '.checkpoint')
 
     # Print Simple Reports from Harvest
-    print("\nRead %d bytes (%.2f compression)" % (nDataBytes, float(nDataBytes) / nRawBytes))
-    print("Wrote out %d records" % recordCount)
+    print("\n" + harvestTransport.transferReport())
+    if pageArchive:
+        pageArchive.close()
+        print("Archived %d pages to %s" % (pageArchive.pageCount, args.archive))
+    if analyzer:
+        analyzer.report()
+    if replacedChars['count']:
+        print("Replaced %d characters not allowed in XML with '?'"
+              % replacedChars['count'])
+    print("%s %d records" % ('Analyzed' if args.noFile else 'Wrote out',
+                             recordCount))
+    harvestMetrics.finish()
 
 
 if __name__ == "__main__":
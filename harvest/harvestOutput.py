@@ -0,0 +1,98 @@
+"""Output Files for the Harvesters, Compressed as they are Written.
+
+The compression is picked from the file extension (.gz, .zst) or asked for
+by name, in which case the extension is added to the file name. zstd needs
+the optional zstandard package.
+"""
+import gzip
+import io
+import os
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIONS = ('gzip', 'zstd')
+EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+# Most of the Size Saving at Much Less CPU than gzip's Default 9
+GZIP_LEVEL = 6
+
+
+def compressionFor(fname, compression=None):
+    """Return the compression to write fname with, or None."""
+    if compression:
+        return(compression)
+    for name, ext in EXTENSIONS.items():
+        if fname.endswith(ext):
+            return(name)
+    return(None)
+
+
+def available(compression):
+    return(compression != 'zstd' or zstandard is not None)
+
+
+def outputFilename(fname, compression):
+    """Add the compression's extension to fname if it's missing."""
+    if compression and not fname.endswith(EXTENSIONS[compression]):
+        fname += EXTENSIONS[compression]
+    return(fname)
+
+
+def addArgument(parser):
+    """Add the -z option to a harvester's ArgumentParser."""
+    parser.add_argument("-z", "--compress", dest="compress",
+                        choices=COMPRESSIONS, help="compress the output as \
+                        it is written (also chosen by a .gz or .zst file \
+                        extension)")
+
+
+def prepareFilename(parser, fname, compression=None):
+    """Return fname with the extension of its compression added, stopping
+       with a parser error if that compression isn't available."""
+    compression = compressionFor(fname, compression)
+    if not available(compression):
+        parser.error("%s output needs the zstandard package" % compression)
+    return(outputFilename(fname, compression))
+
+
+def splitFilename(fname):
+    """Split fname into a root and its extension, keeping a compression
+       extension with the one before it: harvest.xml.gz -> harvest, .xml.gz"""
+    root, ext = os.path.splitext(fname)
+    if ext in EXTENSIONS.values():
+        root, inner = os.path.splitext(root)
+        ext = inner + ext
+    return(root, ext)
+
+
+def openOutput(fname, compression=None, text=False):
+    """Open fname for writing, compressing with compression (by default
+       whatever its extension says). text gives a UTF-8 text file."""
+    compression = compressionFor(fname, compression)
+    if compression is None:
+        if text:
+            return(open(fname, 'w'))
+        return(open(fname, 'wb'))
+    if compression == 'gzip':
+        ofile = gzip.open(fname, 'wb', compresslevel=GZIP_LEVEL)
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise ImportError("zstd output needs the zstandard package")
+        ofile = zstandard.ZstdCompressor().stream_writer(open(fname, 'wb'))
+    if text:
+        return(io.TextIOWrapper(ofile, encoding='utf-8'))
+    return(ofile)
+
+
+def openInput(fname):
+    """Open fname for reading as bytes, decompressing by its extension."""
+    compression = compressionFor(fname)
+    if compression == 'gzip':
+        return(gzip.open(fname, 'rb'))
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise ImportError("zstd input needs the zstandard package")
+        return(zstandard.ZstdDecompressor().stream_reader(open(fname, 'rb')))
+    return(open(fname, 'rb'))
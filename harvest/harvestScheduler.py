@@ -0,0 +1,187 @@
+"""Harvest Many OAI-PMH Endpoints at Once, Politely.
+
+Reads a registry of endpoints and harvests them at the same time from a pool
+of worker threads, so a nightly run takes about as long as its slowest
+endpoint. Requests to each host are rate limited with a token bucket, kept
+to what the host can handle by an adaptive concurrency limit, and the
+connections in use across all endpoints are capped, all in harvestTransport.
+A summary of the run is printed and written out as JSON.
+
+The registry is a JSON list of endpoints:
+
+    [{"link": "https://fsu.digital.flvc.org/oai2", "mdprefix": "mods",
+      "output": "harvests/fsu.mods.xml"},
+     {"name": "cornell-theses", "link": "https://ecommons.cornell.edu/dspace-oai/request",
+      "set": "com_1813_2936", "output": "harvests/cornell.xml.gz",
+      "rate": 0.5}]
+
+link and output are required; name, mdprefix (default oai_dc), set, from,
+until, prefetch, and rate/burst (this host's limit) are optional.
+
+usage: python harvestScheduler.py registry.json [-w workers] [--rate rate]
+"""
+from __future__ import unicode_literals
+import json
+import os
+import time
+from argparse import ArgumentParser, Namespace
+from datetime import datetime
+from urllib.parse import urlparse
+import harvestMetrics
+import harvestOAI
+import harvestOutput
+import harvestTransport
+import harvestWorkers
+
+
+def loadRegistry(fname):
+    """Read the endpoints from a registry file, checking each has a link and
+       its own output file."""
+    with open(fname) as rfile:
+        endpoints = json.load(rfile)
+    outputs = set()
+    for n, endpoint in enumerate(endpoints):
+        if not endpoint.get('link') or not endpoint.get('output'):
+            raise ValueError("endpoint %d needs a link and an output" % n)
+        if not endpoint['link'].startswith('http'):
+            endpoint['link'] = 'http://' + endpoint['link']
+        if endpoint['output'] in outputs:
+            raise ValueError("more than one endpoint writes to %s"
+                             % endpoint['output'])
+        outputs.add(endpoint['output'])
+        endpoint.setdefault('name', urlparse(endpoint['link']).netloc)
+    return(endpoints)
+
+
+def harvestEndpoint(endpoint, result, prefetch=0):
+    """Harvest one endpoint's ListRecords chain into its output file,
+       keeping result up to date with the records written."""
+    args = Namespace(link=endpoint['link'], setName=endpoint.get('set'),
+                     fromDate=endpoint.get('from'), until=endpoint.get('until'),
+                     mdprefix=endpoint.get('mdprefix', 'oai_dc'),
+                     prefetch=endpoint.get('prefetch', prefetch))
+    command = 'ListRecords' + harvestOAI.generateOAIopts(args)
+    outdir = os.path.dirname(endpoint['output'])
+    if outdir and not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    # On Failure, Still Close the File so it is Well-Formed.
+    writer = harvestOAI.openWriter(endpoint['output'])
+    writer.start()
+    try:
+        harvestOAI.harvestChain(args, command, writer)
+    finally:
+        writer.close()
+        result['records'] = writer.recordCount
+
+
+def runHarvests(endpoints, workers, prefetch=0):
+    """Harvest every endpoint, workers at a time. Returns one result per
+       endpoint: its name, link, output, status, records and seconds."""
+    results = []
+    for endpoint in endpoints:
+        results.append({'name': endpoint['name'], 'link': endpoint['link'],
+                        'output': endpoint['output'], 'status': 'waiting',
+                        'records': 0, 'seconds': 0.0})
+
+    def harvest(n):
+        result = results[n]
+        result['status'] = 'running'
+        started = time.time()
+        try:
+            harvestEndpoint(endpoints[n], result, prefetch)
+            result['status'] = 'ok'
+        finally:
+            result['seconds'] = round(time.time() - started, 3)
+
+    failures = harvestWorkers.runWorkers(harvest, range(len(endpoints)), workers)
+    for n, exValue in failures.items():
+        results[n]['status'] = 'failed'
+        results[n]['error'] = repr(exValue)
+    return(results)
+
+
+def writeSummary(fname, results, started, seconds):
+    summary = {'started': started, 'seconds': round(seconds, 3),
+               'endpointSeconds': round(sum(r['seconds'] for r in results), 3),
+               'records': sum(r['records'] for r in results),
+               'failed': len([r for r in results if r['status'] != 'ok']),
+               'endpoints': results}
+    with open(fname, 'w') as sfile:
+        json.dump(summary, sfile, indent=2)
+    return(summary)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("registry", help="JSON file listing the endpoints")
+    parser.add_argument("-w", "--workers", dest="workers", type=int,
+                        default=8, help="number of endpoints to harvest at \
+                        the same time")
+    parser.add_argument("--rate", dest="rate", type=float, default=1.0,
+                        help="requests a second allowed to each host, 0 for \
+                        no limit (an endpoint's own rate overrides this)")
+    parser.add_argument("--burst", dest="burst", type=int, default=2,
+                        help="requests allowed to a host in a burst")
+    parser.add_argument("--connections", dest="connections", type=int,
+                        default=16, help="connections in use at once over all \
+                        endpoints, 0 for no cap")
+    parser.add_argument("--max-per-host", dest="maxPerHost", type=int,
+                        default=4, help="most requests in flight to one host; \
+                        fewer are used while its latency rises or it answers \
+                        429/503")
+    parser.add_argument("-p", "--prefetch", dest="prefetch", type=int,
+                        default=0, help="fetch up to this many pages ahead \
+                        of the writer for each endpoint")
+    parser.add_argument("--summary", dest="summary",
+                        default="harvest-summary.json",
+                        help="write the run summary to this file")
+    harvestMetrics.addArguments(parser)
+    args = parser.parse_args()
+
+    try:
+        endpoints = loadRegistry(args.registry)
+    except (IOError, OSError, ValueError) as exValue:
+        parser.error("can't use registry %s: %s" % (args.registry, exValue))
+    for endpoint in endpoints:
+        harvestOutput.prepareFilename(parser, endpoint['output'])
+
+    harvestMetrics.enableFromArgs('harvestScheduler', args)
+
+    # Politeness Limits, and a Pooled Connection for Every Host
+    harvestTransport.setRateLimit(args.rate or None, args.burst)
+    for endpoint in endpoints:
+        if 'rate' in endpoint:
+            harvestTransport.setRateLimit(endpoint['rate'],
+                                          endpoint.get('burst', args.burst),
+                                          urlparse(endpoint['link']).netloc)
+    harvestTransport.setConnectionCap(args.connections)
+    harvestTransport.setAdaptive(args.maxPerHost)
+    hosts = set(urlparse(e['link']).netloc for e in endpoints)
+    harvestTransport.setPoolSize(max(args.workers, len(hosts)))
+
+    print("Harvesting %d endpoints on %d hosts, %d at a time"
+          % (len(endpoints), len(hosts), args.workers))
+    started = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+    startTime = time.time()
+    results = runHarvests(endpoints, args.workers, args.prefetch)
+    summary = writeSummary(args.summary, results, started,
+                           time.time() - startTime)
+
+    # Print the Combined Run Summary
+    print("\n" + harvestTransport.transferReport())
+    for result in results:
+        print("%-30s %-7s %9d records %9.1fs  %s"
+              % (result['name'][:30], result['status'], result['records'],
+                 result['seconds'], result['output']))
+    print("Wrote out %d records from %d endpoints (%d failed) in %.1fs; \
+%.1fs harvesting one after another" % (summary['records'], len(results),
+                                       summary['failed'], summary['seconds'],
+                                       summary['endpointSeconds']))
+    print("Summary written to %s" % args.summary)
+    harvestMetrics.finish()
+    if summary['failed']:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,19 @@
 """Harvest metadata mapped to field label from SharedShelf API-Requires Auth"""
 from argparse import ArgumentParser
 import os
-import requests
+import harvestMetrics
+import harvestOutput
+import harvestTransport
 import json
+import time
 import re
 import csv
 import errno
 
 base_url = 'http://catalog.sharedshelf.artstor.org/'
-url_rest = '/assets?with_meta=true&limit=5000000'
-publ_re = re.compile("^publishing_status[.-]\d+")
+url_rest = '/assets?with_meta=true'
+PAGE_SIZE = 1000
+publ_re = re.compile(r"^publishing_status[.-]\d+")
 
 
 def getCookies(args, parser):
@@ -17,12 +21,14 @@ def getCookies(args, parser):
     try:
         if args.email and args.password:
             data = {'email': args.email, 'password': args.password}
-            cookies = requests.post(base_url + 'account', data=data).cookies
+            cookies = harvestTransport.post(base_url + 'account',
+                                           data=data).cookies
         elif not args.email or not args.password:
             email = os.environ['ArtStor email:']
             password = os.environ['ArtStor password:']
             data = {'email': email, 'password': password}
-            cookies = requests.post(base_url + 'account', data=data).cookies
+            cookies = harvestTransport.post(base_url + 'account',
+                                           data=data).cookies
         return(cookies)
     except Exception:
         parser.print_help()
@@ -30,18 +36,37 @@ def getCookies(args, parser):
         exit()
 
 
-def callAPI(base_url, coll_id, cookies):
-    # Grab assets data for each unique SharedShelf Collection
+def callAPI(base_url, coll_id, cookies, start=0, limit=PAGE_SIZE):
+    # Grab a page of assets data for a SharedShelf Collection
     url = base_url + 'projects/' + str(coll_id) + url_rest
-    data_start = requests.get(url, cookies=cookies)
+    data_start = harvestTransport.get(url, cookies=cookies,
+                                      params={'start': start, 'limit': limit})
     data_start.encoding = 'utf8'
     data = data_start.json()
     return(data)
 
 
+def iterAssetPages(base_url, coll_id, cookies):
+    """Yield each page of a collection's assets, so only one page is held
+       in memory at a time. Paging runs to the total the API gives, as it
+       may cap pages below PAGE_SIZE; without one it stops at a short page."""
+    start = 0
+    while True:
+        data = callAPI(base_url, coll_id, cookies, start, PAGE_SIZE)
+        if not data['assets']:
+            return
+        yield data
+        start += len(data['assets'])
+        if 'total' in data:
+            if start >= data['total']:
+                return
+        elif len(data['assets']) < PAGE_SIZE:
+            return
+
+
 def getCollections(cookies, proj_id):
     """Get + return data for all collections in SharedShelf."""
-    projs_start = requests.get(base_url + 'projects', cookies=cookies)
+    projs_start = harvestTransport.get(base_url + 'projects', cookies=cookies)
     projs_start.encoding = 'utf8'
     projs = projs_start.json()
     colls = {}
@@ -67,49 +92,68 @@ def getCollections(cookies, proj_id):
 
 
 def generateDataDump(cookies, colls, filename):
-    total = 0
-    output = {}
-    for coll_id in colls:
-        print("Retrieving project %s" % colls[coll_id])
-        data = callAPI(base_url, coll_id, cookies)
-
-        # Grab SharedShelf metadata fields for mapping values to text fields.
-        fields_ss = data['metaData']['columns']
-        assets = data['assets']
-        fields = {}
-        for n in range(len(fields_ss)):
-            if publ_re.match(fields_ss[n]['dataIndex']) and 'publishing_status' not in fields:
-                fields['publishing_status'] = ('publishing_status')
-            else:
-                fields[(fields_ss[n]['dataIndex'])] = (fields_ss[n]['header'])
-        for n in range(len(assets)):
-            for field in assets[n]:
-                if field not in fields and field.replace('_multi_s', '_mfcl_lookup') in fields:
-                    fields[field] = fields[field.replace('_multi_s', '_mfcl_lookup')] + "_facet"
-                elif field not in fields:
-                    fields[field] = field
-
-        # Grab SharedShelf metadata field values and store in output.
-        for n in range(len(assets)):
-            record_id = assets[n]['id']
-            output[record_id] = {}
-            total += 1
-            for field in assets[n]:
-                if field in fields:
-                    field_label = fields[field]
-                    output[record_id][field_label] = assets[n][field]
-                else:
-                    output[record_id][field] = assets[n][field]
-                    print("MISSING FIELD: " + field + ": " + data['assets'][n][field])
-
     if not os.path.exists(os.path.dirname(filename)) and os.path.dirname(filename):
         try:
             os.makedirs(os.path.dirname(filename))
         except OSError as exc:
             if exc.errno != errno.EEXIST:
                 raise
-    with open(filename, 'w') as ofile:
-        json.dump(output, ofile)
+
+    # Write Each Mapped Asset Out as it is Made, Into One JSON Object Keyed
+    # by Asset id. On Failure, Close the Object so the Assets so Far are
+    # Usable.
+    total = 0
+    ofile = harvestOutput.openOutput(filename, text=True)
+    ofile.write('{')
+    try:
+        for coll_id in colls:
+            print("Retrieving project %s" % colls[coll_id])
+            fields = None
+            for p, data in enumerate(iterAssetPages(base_url, coll_id, cookies)):
+                mapStart = time.time()
+
+                # Grab SharedShelf metadata fields for mapping values to text
+                # fields, from the first page.
+                if fields is None:
+                    fields_ss = data['metaData']['columns']
+                    fields = {}
+                    for n in range(len(fields_ss)):
+                        if publ_re.match(fields_ss[n]['dataIndex']) and 'publishing_status' not in fields:
+                            fields['publishing_status'] = ('publishing_status')
+                        else:
+                            fields[(fields_ss[n]['dataIndex'])] = (fields_ss[n]['header'])
+                assets = data['assets']
+                for n in range(len(assets)):
+                    for field in assets[n]:
+                        if field not in fields and field.replace('_multi_s', '_mfcl_lookup') in fields:
+                            fields[field] = fields[field.replace('_multi_s', '_mfcl_lookup')] + "_facet"
+                        elif field not in fields:
+                            fields[field] = field
+
+                # Grab SharedShelf metadata field values and write them out.
+                for n in range(len(assets)):
+                    record_id = assets[n]['id']
+                    record = {}
+                    for field in assets[n]:
+                        if field in fields:
+                            field_label = fields[field]
+                            record[field_label] = assets[n][field]
+                        else:
+                            record[field] = assets[n][field]
+                            print("MISSING FIELD: " + field + ": " + data['assets'][n][field])
+                    ofile.write('%s\n%s: %s' % (',' if total else '',
+                                                json.dumps(str(record_id)),
+                                                json.dumps(record)))
+                    total += 1
+                ofile.flush()
+                harvestMetrics.recordPage({'label': 'project %s page %d'
+                                           % (coll_id, p + 1),
+                                           'records': len(assets),
+                                           'map': time.time() - mapStart})
+    finally:
+        ofile.write('\n}\n')
+        ofile.close()
+    print(harvestTransport.transferReport())
     print("Wrote out %d records" % total)
 
 
@@ -118,7 +162,7 @@ def generateMetadataDump(cookies, colls):
 
     for coll_id in colls:
         print("Retrieving metadata mapping from project %s" % colls[coll_id])
-        data = callAPI(base_url, coll_id, cookies)
+        data = callAPI(base_url, coll_id, cookies, limit=1)
 
         # Grab SharedShelf metadata fields for mapping values to text fields.
         fields_ss = data['metaData']['columns']
@@ -173,8 +217,18 @@ def main():
     parser.add_argument("-m", "--metadata", dest="metadata", default=False,
                         action="store_true", help="Return collated metadata \
                         label to SharedShelf API field codes dictionaries.")
+    harvestOutput.addArgument(parser)
+    harvestTransport.addCacheArguments(parser)
+    harvestMetrics.addArguments(parser)
     args = parser.parse_args()
 
+    # Record Metrics, Answer Repeated Requests from the Cache, and Add the
+    # Extension for Compressed Output, if Asked
+    harvestMetrics.enableFromArgs('harvestSharedShelf', args)
+    harvestTransport.setCacheFromArgs(args)
+    args.filename = harvestOutput.prepareFilename(parser, args.filename,
+                                                  args.compress)
+
     # Authenticating the User on the SharedShelf API.
     cookies = getCookies(args, parser)
 
@@ -192,6 +246,7 @@ def main():
             spec_id = None
         colls = getCollections(cookies, spec_id)
         generateDataDump(cookies, colls, args.filename)
+    harvestMetrics.finish()
 
 
 if __name__ == "__main__":
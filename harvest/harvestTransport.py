@@ -0,0 +1,557 @@
+"""Shared HTTP Transport for the Harvesters.
+
+One requests Session with pooled keep-alive connections is used for every
+request, gzip/deflate transfer compression is negotiated explicitly, and the
+bytes read off the wire are counted separately from the decoded bytes.
+Transient failures (429/5xx, timeouts, dropped connections) are retried with
+exponential backoff and jitter, honouring Retry-After. Every request's timings
+(DNS, connect, first byte, total), bytes and retries go to harvestMetrics.
+
+Requests to each host can be rate limited with a token bucket, and the number
+of connections in use at once across all hosts can be capped, for harvesting
+many endpoints at the same time politely. With setAdaptive, the requests in
+flight to each host are also limited by an AIMD controller: the limit grows by
+one while latency holds steady and is halved when latency rises or the host
+answers 429/503, and every change is printed.
+
+With setCache, GET responses are kept in an on-disk harvestCache, so rerunning
+the same API queries reads them from disk, revalidating them once stale.
+"""
+import random
+import socket
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_tz, mktime_tz
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+import harvestCache
+import harvestMetrics
+
+POOL_SIZE = 10
+ACCEPT_ENCODING = 'gzip, deflate'
+TIMEOUT = (15, 120)
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 120.0
+RETRY_STATUS = (429, 500, 502, 503, 504)
+OVERLOAD_STATUS = (429, 502, 503, 504)
+LATENCY_WINDOW = 50
+LATENCY_FACTOR = 2.0
+LATENCY_SLACK = 0.05
+LATENCY_SAMPLES = 5
+
+session = None
+sessionLock = threading.Lock()
+statsLock = threading.Lock()
+stats = {'requests': 0, 'wireBytes': 0, 'decodedBytes': 0}
+# DNS and Connect Times of the Connection Opened (if any) for the Request
+# Currently Being Sent by this Thread.
+timing = threading.local()
+# Per-Host Rate Limits: hostLimits Holds Those Set for a Host, and Other
+# Hosts Get HOST_RATE Requests a Second. Then the Semaphore Capping
+# Connections in Use (None for No Cap).
+HOST_RATE = None
+HOST_BURST = 1
+hostLimits = {}
+buckets = {}
+bucketsLock = threading.Lock()
+connectionSlots = None
+# Maximum Requests in Flight to a Host under Adaptive Control (None for
+# Off), and Each Host's Controller.
+ADAPTIVE_MAX = None
+controllers = {}
+controllersLock = threading.Lock()
+# On-Disk Cache of GET Responses (None for Off)
+cache = None
+
+
+class HarvestError(Exception):
+    """A request that still failed after all its retries."""
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return "%s" % (self.value,)
+
+
+def timedConnect(conn, connect):
+    """Open conn, noting DNS and connect (TCP plus any TLS) times when
+       metrics are being recorded. The lookup is then timed on its own
+       first; connecting resolves again, normally from the resolver's
+       cache."""
+    if harvestMetrics.recorder is None:
+        connect(conn)
+        return
+    start = time.time()
+    try:
+        socket.getaddrinfo(conn.host, conn.port, 0, socket.SOCK_STREAM)
+    except socket.error:
+        pass
+    resolved = time.time()
+    connect(conn)
+    timing.dns = resolved - start
+    timing.connect = time.time() - resolved
+
+
+class TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        timedConnect(self, HTTPConnection.connect)
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        timedConnect(self, HTTPSConnection.connect)
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedAdapter(HTTPAdapter):
+    """HTTPAdapter whose connections record how long they took to open."""
+    def init_poolmanager(self, *args, **kwargs):
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool}
+
+
+class TokenBucket(object):
+    """Allow rate requests a second on average, in bursts of up to burst."""
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Take a token, returning how many seconds to wait before it can be
+           used. Waiting threads reserve tokens in turn, so they are let
+           through in order."""
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return(0.0)
+            return(-self.tokens / self.rate)
+
+
+def setRateLimit(rate, burst=1, host=None):
+    """Limit requests to host (to each host by default) to rate a second,
+       in bursts of up to burst. A rate of None removes the limit."""
+    global HOST_RATE, HOST_BURST
+    with bucketsLock:
+        if host is None:
+            HOST_RATE, HOST_BURST = rate, burst
+        else:
+            hostLimits[host] = (rate, burst)
+        # Buckets are Made Again with the New Limits When Next Needed.
+        buckets.clear()
+
+
+def throttle(host):
+    """Wait until host's rate limit allows another request."""
+    with bucketsLock:
+        bucket = buckets.get(host)
+        if bucket is None:
+            rate, burst = hostLimits.get(host, (HOST_RATE, HOST_BURST))
+            if rate:
+                bucket = buckets[host] = TokenBucket(rate, burst)
+    if bucket is not None:
+        wait = bucket.take()
+        if wait:
+            time.sleep(wait)
+
+
+def setConnectionCap(cap):
+    """Allow at most cap connections in use at once over all hosts (None or
+       0 for no cap). A streamed response holds its connection until its
+       body has been read with iterBody or readBody, or it is discarded."""
+    global connectionSlots
+    connectionSlots = threading.BoundedSemaphore(cap) if cap else None
+
+
+class HostController(object):
+    """AIMD limit on the requests in flight to one host. The limit starts
+       at one and grows by one after a full limit's worth of responses come
+       back without latency rising, while the limit is actually in use. It
+       is halved on a 429/503 (or other overload status), a timeout or
+       dropped connection, or when the smoothed time to first byte climbs
+       past LATENCY_FACTOR times the fastest recent one (plus LATENCY_SLACK,
+       so jitter on fast hosts doesn't count); only once for the
+       requests that were in flight when it was last cut."""
+    def __init__(self, host, maxLimit):
+        self.host = host
+        self.maxLimit = maxLimit
+        self.limit = 1
+        self.active = 0
+        self.cond = threading.Condition()
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.smoothed = None
+        self.good = 0
+        self.saturated = False
+        self.started = 0
+        self.cutAt = 0
+
+    def acquire(self):
+        """Wait for room under the limit. Returns the request's number."""
+        with self.cond:
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.active += 1
+            if self.active >= self.limit:
+                self.saturated = True
+            self.started += 1
+            return(self.started)
+
+    def release(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify()
+
+    def observe(self, number, latency=None, overloaded=False):
+        """Adjust the limit for the outcome of request number."""
+        with self.cond:
+            reason = None
+            if overloaded:
+                reason = 'overloaded'
+            else:
+                self.latencies.append(latency)
+                if self.smoothed is None:
+                    self.smoothed = latency
+                self.smoothed = 0.7 * self.smoothed + 0.3 * latency
+                baseline = min(self.latencies)
+                if (len(self.latencies) >= LATENCY_SAMPLES and
+                        self.smoothed > LATENCY_FACTOR * baseline +
+                        LATENCY_SLACK):
+                    reason = 'latency %.2fs, was %.2fs' % (self.smoothed,
+                                                           baseline)
+            if reason:
+                if number > self.cutAt:
+                    # Judge the Lower Limit by Requests Sent Under it Only.
+                    self.cutAt = self.started
+                    self.smoothed = None
+                    self.setLimit(max(1, self.limit // 2), reason)
+                return
+            self.good += 1
+            if (self.good >= self.limit and self.saturated and
+                    self.limit < self.maxLimit):
+                self.setLimit(self.limit + 1, 'latency steady at %.2fs'
+                              % self.smoothed)
+
+    def setLimit(self, limit, reason):
+        if limit != self.limit:
+            print("Concurrency for %s: %d -> %d (%s)"
+                  % (self.host, self.limit, limit, reason))
+        self.limit = limit
+        self.good = 0
+        self.saturated = False
+        self.cond.notify_all()
+
+
+def setAdaptive(maxConcurrency):
+    """Control the requests in flight to each host with a HostController,
+       allowing up to maxConcurrency (None or 0 turns the control off)."""
+    global ADAPTIVE_MAX
+    with controllersLock:
+        ADAPTIVE_MAX = maxConcurrency or None
+        controllers.clear()
+
+
+def hostController(host):
+    """Return host's HostController, or None without adaptive control."""
+    with controllersLock:
+        if ADAPTIVE_MAX is None:
+            return(None)
+        if host not in controllers:
+            controllers[host] = HostController(host, ADAPTIVE_MAX)
+        return(controllers[host])
+
+
+class RequestSlot(object):
+    """What a request attempt holds while it runs: a place under its host's
+       concurrency limit and a global connection slot."""
+    def __init__(self, host):
+        self.controller = hostController(host)
+        self.number = self.controller.acquire() if self.controller else 0
+        self.slots = connectionSlots
+        if self.slots is not None:
+            self.slots.acquire()
+
+    def observe(self, latency=None, overloaded=False):
+        if self.controller:
+            self.controller.observe(self.number, latency, overloaded)
+
+    def release(self):
+        if self.slots is not None:
+            self.slots.release()
+            self.slots = None
+        if self.controller:
+            self.controller.release()
+            self.controller = None
+
+
+def releaseSlot(resp):
+    """Give back the slot resp holds, if any."""
+    slot = getattr(resp, 'harvestSlot', None)
+    if slot is not None:
+        resp.harvestSlot = None
+        slot.release()
+
+
+def discard(resp):
+    """Close a streamed response whose body won't be read."""
+    resp.close()
+    releaseSlot(resp)
+
+
+def mountAdapters(sess, poolSize):
+    adapter = TimedAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+    sess.mount('http://', adapter)
+    sess.mount('https://', adapter)
+
+
+def getSession():
+    """Return the shared Session, creating it on first use."""
+    global session
+    with sessionLock:
+        if session is None:
+            session = requests.Session()
+            session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+            mountAdapters(session, POOL_SIZE)
+    return(session)
+
+
+def setPoolSize(poolSize):
+    """Keep up to poolSize connections open per host, e.g. one per worker."""
+    global POOL_SIZE
+    POOL_SIZE = max(poolSize, 1)
+    mountAdapters(getSession(), POOL_SIZE)
+
+
+def recordTransfer(resp, decodedBytes):
+    """Count a response's bytes once its body has been read, and hand its
+       timings to harvestMetrics."""
+    releaseSlot(resp)
+    wire = wireBytes(resp)
+    with statsLock:
+        stats['wireBytes'] += wire
+        stats['decodedBytes'] += decodedBytes
+    entry = getattr(resp, 'harvestTiming', None)
+    if entry is not None:
+        entry['total'] = time.time() - entry.pop('start')
+        entry['wireBytes'] = wire
+        entry['decodedBytes'] = decodedBytes
+        harvestMetrics.recordRequest(entry)
+
+
+def wireBytes(resp):
+    """Bytes of the response body read from the socket, before decoding."""
+    try:
+        return(resp.raw.tell())
+    except AttributeError:
+        return(0)
+
+
+def backoff(attempt):
+    """Exponential backoff with jitter for the given retry attempt (from 1)."""
+    wait = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1))
+    return(random.uniform(wait / 2, wait))
+
+
+def retryAfter(resp):
+    """Seconds asked for in a Retry-After header (delay or HTTP date)."""
+    value = resp.headers.get('Retry-After')
+    if not value:
+        return(None)
+    try:
+        return(max(0, int(value)))
+    except ValueError:
+        date = parsedate_tz(value)
+        if date is None:
+            return(None)
+        return(max(0, mktime_tz(date) - time.time()))
+
+
+def request(method, url, stream=False, **kwargs):
+    """Send a request through the shared Session, retrying transient failures.
+
+       Responses with a status in RETRY_STATUS are retried up to MAX_ATTEMPTS
+       times, waiting for Retry-After when given; the last such response is
+       returned for the caller to handle. Timeouts and dropped connections
+       are counted and retried separately, and raise HarvestError once either
+       runs out of attempts. Unless stream is set the body is read straight
+       away and counted; streamed bodies should be read with iterBody or
+       readBody (or dropped with discard) so they are counted too and give
+       back their slot. Every attempt waits for the host's rate limit, room
+       under its adaptive concurrency limit and a free connection slot
+       first."""
+    kwargs.setdefault('timeout', TIMEOUT)
+    attempts = {'status': 0, 'timeout': 0, 'connection': 0}
+    host = urlparse(url).netloc
+    while True:
+        throttle(host)
+        slot = RequestSlot(host)
+        timing.dns = timing.connect = 0.0
+        start = time.time()
+        try:
+            resp = getSession().request(method, url, stream=stream, **kwargs)
+        except requests.Timeout as exValue:
+            failure, reason = 'timeout', exValue
+        except (requests.ConnectionError,
+                requests.exceptions.ChunkedEncodingError) as exValue:
+            failure, reason = 'connection', exValue
+        except BaseException:
+            # Anything Else isn't Retried, but Must Still Give its Slot Back
+            # or Later Requests to the Host Wait for it Forever.
+            slot.release()
+            raise
+        else:
+            resp.harvestSlot = slot
+            slot.observe(resp.elapsed.total_seconds(),
+                         resp.status_code in OVERLOAD_STATUS)
+            if not stream:
+                releaseSlot(resp)
+            with statsLock:
+                stats['requests'] += 1
+            if resp.status_code not in RETRY_STATUS:
+                resp.harvestTiming = {
+                    'url': resp.url, 'host': urlparse(resp.url).netloc,
+                    'status': resp.status_code, 'start': start,
+                    'dns': timing.dns, 'connect': timing.connect,
+                    'firstByte': resp.elapsed.total_seconds(),
+                    'retries': sum(attempts.values())}
+                if not stream:
+                    recordTransfer(resp, len(resp.content))
+                return(resp)
+            failure, reason = 'status', 'HTTP %d' % resp.status_code
+        if failure != 'status':
+            slot.observe(overloaded=True)
+            slot.release()
+
+        attempts[failure] += 1
+        if attempts[failure] >= MAX_ATTEMPTS:
+            if failure == 'status':
+                return(resp)
+            raise HarvestError("Giving up on %s after %d attempts: %s"
+                               % (url, attempts[failure], reason))
+        wait = None
+        if failure == 'status':
+            wait = retryAfter(resp)
+            discard(resp)
+        if wait is None:
+            wait = backoff(attempts[failure])
+        print("Retrying %s in %.1f seconds (%s)" % (url[-90:], wait, reason))
+        time.sleep(wait)
+
+
+def setCache(directory, ttl, maxBytes):
+    """Keep GET responses in directory, answering repeats from it for ttl
+       seconds, in at most maxBytes (None directory turns the cache off)."""
+    global cache
+    cache = None
+    if directory:
+        cache = harvestCache.ResponseCache(directory, ttl, maxBytes)
+
+
+def addCacheArguments(parser):
+    """Add the --cache options to a harvester's ArgumentParser."""
+    parser.add_argument("--cache", dest="cache",
+                        help="keep API responses in this directory and answer \
+                        repeated requests from it")
+    parser.add_argument("--cache-ttl", dest="cacheTTL", type=float,
+                        default=24, help="hours a cached response is used \
+                        before checking it with the server")
+    parser.add_argument("--cache-mb", dest="cacheMB", type=int, default=1024,
+                        help="most MB kept in the cache, removing the least \
+                        recently used responses past that")
+
+
+def setCacheFromArgs(args):
+    """Answer repeated requests from the on-disk cache if args ask for it."""
+    if args.cache:
+        setCache(args.cache, args.cacheTTL * 3600, args.cacheMB * 1048576)
+
+
+def cachedGet(url, **kwargs):
+    """GET through the cache: answered from disk while fresh, revalidated
+       with the server's validators once stale, and stored when a 200."""
+    key = cache.key('GET', url, kwargs.get('params'))
+    headers = dict(kwargs.pop('headers', None) or {})
+    entry = cache.lookup(key)
+    validators = {}
+    if entry is not None:
+        if cache.fresh(entry):
+            try:
+                return(cache.response(key, entry))
+            except (IOError, OSError):
+                # Evicted by Another Thread Since the Lookup
+                entry = None
+        else:
+            validators = cache.validators(entry)
+    resp = request('GET', url, headers=dict(headers, **validators), **kwargs)
+    if resp.status_code == 304 and entry is not None:
+        cache.refresh(key, entry)
+        try:
+            return(cache.response(key, entry))
+        except (IOError, OSError):
+            resp = request('GET', url, headers=headers, **kwargs)
+    if resp.status_code == 200:
+        cache.store(key, resp)
+    return(resp)
+
+
+def get(url, **kwargs):
+    if cache is not None and not kwargs.get('stream'):
+        return(cachedGet(url, **kwargs))
+    return(request('GET', url, **kwargs))
+
+
+def post(url, **kwargs):
+    return(request('POST', url, **kwargs))
+
+
+def iterBody(resp, chunkSize):
+    """Yield the decoded body of a streamed response in chunks."""
+    decodedBytes = 0
+    try:
+        for chunk in resp.iter_content(chunk_size=chunkSize):
+            decodedBytes += len(chunk)
+            yield chunk
+        recordTransfer(resp, decodedBytes)
+    finally:
+        discard(resp)
+
+
+def readBody(resp):
+    """Read the whole decoded body of a streamed response."""
+    try:
+        data = resp.content
+    finally:
+        releaseSlot(resp)
+    recordTransfer(resp, len(data))
+    return(data)
+
+
+def transferReport():
+    """One line summary of the traffic since the harvest started."""
+    with statsLock:
+        ratio = float(stats['decodedBytes']) / max(stats['wireBytes'], 1)
+        report = ("Read %d bytes in %d requests (%d on the wire, %.2f "
+                  "compression)" % (stats['decodedBytes'], stats['requests'],
+                                    stats['wireBytes'], ratio))
+    if cache is not None:
+        report += "; " + cache.report()
+    return(report)
@@ -0,0 +1,34 @@
+"""Pool of Worker Threads, Shared by the Harvesters for Fetching Sets, Date
+Windows, Records, Endpoints and DPLA Query Slices at the Same Time."""
+import threading
+from queue import Queue, Empty
+
+
+def runWorkers(func, items, workers):
+    """Call func on each item from a pool of worker threads. Returns a dict
+       of the items that failed, mapped to the exception they raised."""
+    todo = Queue()
+    for item in items:
+        todo.put(item)
+    failures = {}
+
+    def work():
+        while True:
+            try:
+                item = todo.get(block=False)
+            except Empty:
+                return
+            try:
+                func(item)
+            except BaseException as exValue:
+                # exit() in a worker must not take down the whole harvest.
+                print("FAILED %s: %r" % (item, exValue))
+                failures[item] = exValue
+
+    threads = [threading.Thread(target=work) for n in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return(failures)
@@ -0,0 +1,399 @@
+"""Local Stand-in for OAI-PMH and DPLA API Endpoints, for Offline Harvests.
+
+Serves synthetic records so harvestOAI and harvestDPLA can be tested and
+benchmarked without touching live services:
+
+- /oai answers Identify, ListSets, GetRecord, and ListRecords and
+  ListIdentifiers (with set, from, until and resumptionTokens)
+- /v2/items answers DPLA-style paginated JSON (page, page_size), filtered by
+  admin.contributingInstitution and sourceResource.date.after/before, with
+  admin.contributingInstitution facets, only the requested fields, and
+  refusing pages past maxResults as the API refuses deep paging
+- /projects and /projects/1/assets answer SharedShelf-style JSON, the assets
+  paged with start and limit
+
+Every response has an ETag and a matching If-None-Match gets a 304. Latency
+(fixed, or growing with the requests in flight), 503 responses with
+Retry-After, bodies cut off half way, and gzip can be switched on to see how
+the harvesters cope.
+
+usage: python standinServer.py [-r records] [--port port] [--latency secs]
+"""
+from __future__ import unicode_literals
+import gzip
+import hashlib
+import io
+import json
+import threading
+import time
+from argparse import ArgumentParser
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+oaihead = """<?xml version="1.0" encoding="UTF-8"?><OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.openarchives.org/OAI/2.0/ http://www.openarchives.org/OAI/2.0/OAI-PMH.xsd"><responseDate>%s</responseDate><request verb="%s">%s</request>"""
+oaitail = """</OAI-PMH>"""
+headerxml = """<header><identifier>oai:standin:%d</identifier><datestamp>%s</datestamp><setSpec>%s</setSpec></header>"""
+recordxml = """<record>%s<metadata><oai_dc:dc xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/" xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.openarchives.org/OAI/2.0/oai_dc/ http://www.openarchives.org/OAI/2.0/oai_dc.xsd"><dc:title>Stand-in record %d%s</dc:title><dc:creator>Creator, Number %d</dc:creator><dc:subject>Subject %d</dc:subject><dc:subject>Subject %d</dc:subject><dc:description>%s</dc:description><dc:date>%s</dc:date><dc:type>Text</dc:type><dc:identifier>http://standin.example.org/%d</dc:identifier><dc:rights>http://rightsstatements.org/vocab/InC/1.0/</dc:rights></oai_dc:dc></metadata></record>"""
+description = "Synthetic description text for benchmarking harvests. " * 8
+
+
+class StandinRepository(object):
+    """Synthetic records, one an hour from 2017-01-01, spread over sets."""
+    def __init__(self, records=1000, pageSize=100, sets=4, maxResults=None):
+        self.records = records
+        self.pageSize = pageSize
+        self.maxResults = maxResults
+        start = datetime(2017, 1, 1)
+        self.datestamps = [(start + timedelta(hours=n)).strftime('%Y-%m-%dT%H:%M:%SZ')
+                           for n in range(records)]
+        self.setNames = ['set_%d' % n for n in range(sets)]
+        self.sets = {None: list(range(records))}
+        for name in self.setNames:
+            self.sets[name] = []
+        for n in range(records):
+            for name in self.recordSets(n):
+                self.sets[name].append(n)
+        self.setDates = dict((name, [self.datestamps[n] for n in ids])
+                             for name, ids in self.sets.items())
+
+    def recordSets(self, n):
+        """Every record is in one set, and every fifth in the next set too."""
+        sets = [self.setNames[n % len(self.setNames)]]
+        if n % 5 == 0 and len(self.setNames) > 1:
+            sets.append(self.setNames[(n + 1) % len(self.setNames)])
+        return(sets)
+
+    def headerXML(self, n):
+        return(headerxml % (n, self.datestamps[n],
+                            '</setSpec><setSpec>'.join(self.recordSets(n))))
+
+    def recordXML(self, n):
+        # Every 100th record has a character that isn't allowed in XML.
+        return(recordxml % (self.headerXML(n),
+                            n, '\x0b' if n % 100 == 0 else '', n % 50,
+                            n % 7, n % 11, description, self.datestamps[n][:10],
+                            n))
+
+    def selectRecords(self, setName, fromDate, untilDate):
+        """Ids in setName with datestamps within fromDate..untilDate."""
+        ids = self.sets[setName]
+        dates = self.setDates[setName]
+        lo = bisect_left(dates, fromDate) if fromDate else 0
+        hi = bisect_right(dates, untilDate + '\uffff') if untilDate else len(ids)
+        return(ids[lo:hi])
+
+    def selectDocs(self, params):
+        """Ids of the items matching the DPLA query params. A date range
+           matches the items whose dates overlap it."""
+        institution = params.get('admin.contributingInstitution')
+        after = params.get('sourceResource.date.after')
+        before = params.get('sourceResource.date.before')
+        ids = []
+        for n in range(self.records):
+            date = self.datestamps[n][:10]
+            if institution and institution != self.institution(n):
+                continue
+            if (after and date < after) or (before and date > before):
+                continue
+            ids.append(n)
+        return(ids)
+
+    def assetJSON(self, n):
+        """A SharedShelf-style asset, its fields named by code."""
+        return({'id': n, 'project_id': 1,
+                'fd_1_s': 'Stand-in asset %d' % n,
+                'fd_2_multi_s': ['Subject %d' % (n % 7)],
+                'fd_3_dt': self.datestamps[n][:10]})
+
+    def institution(self, n):
+        return('Stand-in Library %d' % (n % 3))
+
+    def docJSON(self, n):
+        """A DPLA-style item document."""
+        return({'id': '%032x' % n,
+                '@id': 'http://dp.la/api/items/%032x' % n,
+                'dataProvider': self.institution(n),
+                'provider': {'name': 'Stand-in Hub'},
+                'admin': {'contributingInstitution': self.institution(n)},
+                'rights': 'http://rightsstatements.org/vocab/InC/1.0/',
+                'sourceResource': {'title': ['Stand-in record %d' % n],
+                                   'creator': ['Creator, Number %d' % (n % 50)],
+                                   'subject': [{'name': 'Subject %d' % (n % 7)}],
+                                   'date': {'displayDate': self.datestamps[n][:10],
+                                            'begin': self.datestamps[n][:10],
+                                            'end': self.datestamps[n][:10]},
+                                   'description': [description]},
+                'originalRecord': {'metadata': description * 4}})
+
+
+def projectFields(doc, fields):
+    """Only the fields of doc asked for, keyed by their dotted paths as the
+       DPLA API returns them."""
+    projected = {}
+    for field in fields:
+        value = doc
+        for part in field.split('.'):
+            value = value.get(part) if isinstance(value, dict) else None
+        if value is not None:
+            projected[field] = value
+    return(projected)
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requestCount += 1
+            server.active += 1
+            failing = (server.failEvery and
+                       server.requestCount % server.failEvery == 0)
+            truncating = (server.truncateEvery and
+                          server.requestCount % server.truncateEvery == 0)
+            latency = server.latency + server.loadLatency * (server.active - 1)
+        try:
+            if latency:
+                time.sleep(latency)
+            self.respond(failing, truncating)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def respond(self, failing, truncating=False):
+        server = self.server
+        if failing:
+            self.send_response(503)
+            self.send_header('Retry-After', str(server.retryAfter))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        url = urlparse(self.path)
+        params = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        if url.path == '/oai':
+            body, contentType = self.oai(params), 'text/xml; charset=utf-8'
+        elif url.path.startswith('/projects'):
+            body, contentType = self.sharedShelf(url.path, params), 'application/json'
+        elif url.path == '/v2/items':
+            body, contentType = self.dpla(params), 'application/json'
+            if body is None:
+                self.send_error(400, 'Page is past the results allowed')
+                return
+        else:
+            self.send_error(404)
+            return
+        body = body.encode('utf-8')
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            with server.lock:
+                server.notModified += 1
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', contentType)
+        self.send_header('ETag', etag)
+        if server.gzip and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            buf = io.BytesIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6) as gz:
+                gz.write(body)
+            body = buf.getvalue()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if truncating:
+            # Drop the Connection Half Way Through the Body
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def oai(self, params):
+        repo = self.server.repository
+        verb = params.get('verb')
+        head = oaihead % (datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+                          verb, self.server.baseURL + '/oai')
+        if verb == 'Identify':
+            return(head + '<Identify><repositoryName>Stand-in</repositoryName>'
+                   '<earliestDatestamp>%s</earliestDatestamp>'
+                   '<granularity>YYYY-MM-DDThh:mm:ssZ</granularity></Identify>'
+                   % repo.datestamps[0] + oaitail)
+        elif verb == 'ListSets':
+            return(head + '<ListSets>' +
+                   ''.join('<set><setSpec>%s</setSpec><setName>%s</setName></set>'
+                           % (name, name) for name in repo.setNames) +
+                   '</ListSets>' + oaitail)
+        elif verb == 'GetRecord':
+            identifier = params.get('identifier', '')
+            n = identifier.rsplit(':', 1)[-1]
+            if (not identifier.startswith('oai:standin:') or not n.isdigit()
+                    or int(n) >= repo.records):
+                return(head + '<error code="idDoesNotExist">No such record</error>'
+                       + oaitail)
+            return(head + '<GetRecord>' + repo.recordXML(int(n)) +
+                   '</GetRecord>' + oaitail)
+        elif verb not in ('ListRecords', 'ListIdentifiers'):
+            return(head + '<error code="badVerb">Illegal verb</error>' + oaitail)
+
+        # Tokens Carry the Whole Request: offset!set!from!until
+        if 'resumptionToken' in params:
+            offset, setName, fromDate, untilDate = params['resumptionToken'].split('!')
+            offset = int(offset)
+        else:
+            offset = 0
+            setName = params.get('set', '')
+            fromDate = params.get('from', '')
+            untilDate = params.get('until', '')
+        if setName and setName not in repo.sets:
+            return(head + '<error code="badArgument">No such set</error>' + oaitail)
+        ids = repo.selectRecords(setName or None, fromDate, untilDate)
+        if not ids:
+            return(head + '<error code="noRecordsMatch">No records</error>' + oaitail)
+        page = ids[offset:offset + repo.pageSize]
+        out = [head, '<%s>' % verb]
+        if verb == 'ListRecords':
+            out.extend(repo.recordXML(n) for n in page)
+        else:
+            out.extend(repo.headerXML(n) for n in page)
+        if offset + repo.pageSize < len(ids):
+            out.append('<resumptionToken completeListSize="%d" cursor="%d">%d!%s!%s!%s</resumptionToken>'
+                       % (len(ids), offset, offset + repo.pageSize, setName,
+                          fromDate, untilDate))
+        elif offset:
+            out.append('<resumptionToken completeListSize="%d" cursor="%d"/>'
+                       % (len(ids), offset))
+        out.append('</%s>' % verb + oaitail)
+        return(''.join(out))
+
+    def sharedShelf(self, path, params):
+        repo = self.server.repository
+        if path == '/projects':
+            return(json.dumps({'items': [{'id': 1, 'name': 'Stand-in Project'}]}))
+        start = int(params.get('start', 0))
+        # Like the Real API, Pages are Capped Below a Large Limit
+        limit = min(int(params.get('limit', 25)), repo.pageSize)
+        columns = [{'dataIndex': 'fd_1_s', 'header': 'Title'},
+                   {'dataIndex': 'fd_2_mfcl_lookup', 'header': 'Subject'},
+                   {'dataIndex': 'fd_3_dt', 'header': 'Date'},
+                   {'dataIndex': 'publishing_status.1', 'header': 'Published'}]
+        return(json.dumps({'total': repo.records,
+                           'metaData': {'columns': columns},
+                           'assets': [repo.assetJSON(n) for n in
+                                      range(start, min(start + limit, repo.records))]}))
+
+    def dpla(self, params):
+        repo = self.server.repository
+        pageSize = int(params.get('page_size', 10))
+        page = int(params.get('page', 1))
+        start = (page - 1) * pageSize
+        if repo.maxResults and start + pageSize > repo.maxResults:
+            return(None)
+        ids = repo.selectDocs(params)
+        docs = [repo.docJSON(n) for n in ids[start:start + pageSize]]
+        if params.get('fields'):
+            docs = [projectFields(doc, params['fields'].split(','))
+                    for doc in docs]
+        response = {'count': len(ids), 'start': start, 'limit': pageSize,
+                    'docs': docs}
+        if params.get('facets') == 'admin.contributingInstitution':
+            counts = {}
+            for n in ids:
+                counts[repo.institution(n)] = counts.get(repo.institution(n), 0) + 1
+            response['facets'] = {'admin.contributingInstitution': {
+                '_type': 'terms',
+                'terms': [{'term': term, 'count': count}
+                          for term, count in sorted(counts.items())]}}
+        return(json.dumps(response))
+
+
+class StandinServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, repository, latency=0, failEvery=0,
+                 retryAfter=1, gzip=False, verbose=False, loadLatency=0,
+                 truncateEvery=0):
+        HTTPServer.__init__(self, address, StandinHandler)
+        self.repository = repository
+        self.latency = latency
+        self.loadLatency = loadLatency
+        self.active = 0
+        self.failEvery = failEvery
+        self.retryAfter = retryAfter
+        self.truncateEvery = truncateEvery
+        self.gzip = gzip
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.requestCount = 0
+        self.notModified = 0
+        self.baseURL = 'http://%s:%d' % self.server_address[:2]
+
+
+def startServer(port=0, **kwargs):
+    """Start a stand-in server in a background thread. Takes the
+       StandinRepository options (records, pageSize, sets, maxResults) and the
+       StandinServer ones (latency, loadLatency, failEvery, retryAfter,
+       truncateEvery, gzip)."""
+    repoOpts = dict((k, kwargs.pop(k))
+                    for k in ('records', 'pageSize', 'sets', 'maxResults')
+                    if k in kwargs)
+    server = StandinServer(('127.0.0.1', port), StandinRepository(**repoOpts),
+                           **kwargs)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return(server)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("-r", "--records", dest="records", type=int,
+                        default=10000, help="number of synthetic records")
+    parser.add_argument("--page-size", dest="pageSize", type=int, default=100,
+                        help="records per ListRecords page")
+    parser.add_argument("--sets", dest="sets", type=int, default=4,
+                        help="number of OAI-PMH sets")
+    parser.add_argument("--max-results", dest="maxResults", type=int,
+                        default=None, help="refuse DPLA pages past this many \
+                        results, as the API limits deep paging")
+    parser.add_argument("--port", dest="port", type=int, default=8000)
+    parser.add_argument("--latency", dest="latency", type=float, default=0,
+                        help="seconds to wait before every response")
+    parser.add_argument("--load-latency", dest="loadLatency", type=float,
+                        default=0, help="seconds more to wait for every \
+                        other request in flight")
+    parser.add_argument("--fail-every", dest="failEvery", type=int, default=0,
+                        help="answer every Nth request with a 503")
+    parser.add_argument("--retry-after", dest="retryAfter", type=int,
+                        default=1, help="Retry-After seconds sent with 503s")
+    parser.add_argument("--truncate-every", dest="truncateEvery", type=int,
+                        default=0, help="drop the connection half way through \
+                        the body of every Nth response")
+    parser.add_argument("--gzip", dest="gzip", default=False,
+                        action="store_true", help="gzip responses when asked")
+    args = parser.parse_args()
+
+    server = StandinServer(('127.0.0.1', args.port),
+                           StandinRepository(args.records, args.pageSize,
+                                             args.sets, args.maxResults),
+                           args.latency, args.failEvery, args.retryAfter,
+                           args.gzip, verbose=True,
+                           loadLatency=args.loadLatency,
+                           truncateEvery=args.truncateEvery)
+    print("OAI-PMH at %s/oai, DPLA API at %s/v2/items"
+          % (server.baseURL, server.baseURL))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""Testing the DPLA Harvest Module Against the Local Stand-in Server.
+
+Kept apart from test_dplaharvest, which needs DPLA_APIKEY set to import.
+"""
+import unittest
+import harvestDPLA
+import harvestTransport
+import standinServer
+import json
+import os
+import tempfile
+from argparse import Namespace
+
+
+class StandinDPLA(unittest.TestCase):
+    """Harvest from the Stand-in's DPLA API, No Network or API Key Needed."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = standinServer.startServer(records=250)
+        cls.dplaAPI = cls.server.baseURL + '/v2/items?api_key=test'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmpdir = tmpdir.name
+
+    def testDPLAStream(self):
+        """DPLA Records are Written the Same as JSON Lines or a Docs File."""
+        harvested = {}
+        for fname in ('dpla.jsonl', 'dpla.json'):
+            writer = harvestDPLA.DocWriter(os.path.join(self.tmpdir, fname))
+            data = harvestDPLA.dataAPIcall(self.dplaAPI, '', '1')
+            count = harvestDPLA.iterateRecordPull(data, self.dplaAPI, '',
+                                                  writer)
+            writer.close()
+            self.assertEqual(count, 250)
+            with open(os.path.join(self.tmpdir, fname)) as dfile:
+                if fname.endswith('.jsonl'):
+                    harvested[fname] = [json.loads(line) for line in dfile]
+                else:
+                    harvested[fname] = json.load(dfile)['docs']
+        self.assertEqual(len(harvested['dpla.jsonl']), 250)
+        self.assertEqual(harvested['dpla.jsonl'], harvested['dpla.json'])
+
+    def testDPLAFields(self):
+        """Projected Records are Nested Again, Under a List of Their Fields."""
+        fields = ['id', 'sourceResource.subject', 'rights']
+        dplaAPI = self.dplaAPI + '&fields=' + ','.join(fields)
+        fname = os.path.join(self.tmpdir, 'dpla.json')
+        writer = harvestDPLA.DocWriter(fname, fields=fields)
+        data = harvestDPLA.dataAPIcall(dplaAPI, '', '1')
+        harvestDPLA.iterateRecordPull(data, dplaAPI, '', writer)
+        writer.close()
+        with open(fname) as dfile:
+            harvested = json.load(dfile)
+        self.assertEqual(harvested['fields'], fields)
+        self.assertEqual(len(harvested['docs']), 250)
+        self.assertEqual(harvested['docs'][7],
+                         {'id': '%032x' % 7,
+                          'sourceResource': {'subject': [{'name': 'Subject 0'}]},
+                          'rights': 'http://rightsstatements.org/vocab/InC/1.0/'})
+
+    def startServer(self, **kwargs):
+        server = standinServer.startServer(**kwargs)
+        self.addCleanup(server.shutdown)
+        return(server.baseURL + '/v2/items?api_key=test')
+
+    def testDPLAConcurrent(self):
+        """Pages Fetched at Once are Written in Order, Ending at the Last."""
+        dplaAPI = self.startServer(records=1234)
+        fname = os.path.join(self.tmpdir, 'dpla.jsonl')
+        writer = harvestDPLA.DocWriter(fname)
+        requested = harvestTransport.stats['requests']
+        data = harvestDPLA.dataAPIcall(dplaAPI, '', '1')
+        count = harvestDPLA.iterateRecordPull(data, dplaAPI, '', writer, 4)
+        writer.close()
+        self.assertEqual(harvestTransport.stats['requests'] - requested, 3)
+        with open(fname) as dfile:
+            ids = [json.loads(line)['id'] for line in dfile]
+        self.assertEqual(count, 1234)
+        self.assertEqual(ids, ['%032x' % n for n in range(1234)])
+
+    def testDPLASlices(self):
+        """Sliced Queries Get Past the Paging Limit, Without Duplicates."""
+        dplaAPI = self.startServer(records=1234, maxResults=500)
+        fname = os.path.join(self.tmpdir, 'dpla.jsonl')
+        args = Namespace(provider=None, hub='Stand-in Hub', afterDate=None,
+                         beforeDate=None, title=None, keyword=None)
+        writer = harvestDPLA.DocWriter(fname, dedup=True)
+        slices = harvestDPLA.sliceQuery(dplaAPI, args, 'date', 500)
+        self.assertTrue(all(count <= 500 for opts, count in slices))
+        # The First Slice Again, as Overlapping Date Ranges Would Give
+        count = harvestDPLA.harvestSlices(dplaAPI, slices + slices[:1],
+                                          writer, 4)
+        writer.close()
+        with open(fname) as dfile:
+            ids = [json.loads(line)['id'] for line in dfile]
+        self.assertEqual(count, 1234)
+        self.assertEqual(writer.duplicateCount, slices[0][1])
+        self.assertEqual(sorted(ids), ['%032x' % n for n in range(1234)])
+
+    def testDPLASliceFails(self):
+        """The Other Slices are Harvested Before a Failed One Exits."""
+        dplaAPI = self.startServer(records=1234, maxResults=500)
+        args = Namespace(provider=None, hub='Stand-in Hub', afterDate=None,
+                         beforeDate=None, title=None, keyword=None)
+        writer = harvestDPLA.DocWriter(os.path.join(self.tmpdir, 'dpla.jsonl'),
+                                       dedup=True)
+        slices = harvestDPLA.sliceQuery(dplaAPI, args, 'date', 500)
+        # The Whole Query Again, Which Pages Past the Limit
+        with self.assertRaises(SystemExit) as cm:
+            harvestDPLA.harvestSlices(dplaAPI, [('', 1234)] + slices, writer, 1)
+        writer.close()
+        self.assertEqual(cm.exception.code, 1)
+        self.assertEqual(writer.recordCount, 1234)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+"""Testing the On-Disk Response Cache Against the Local Stand-in Server."""
+import unittest
+import harvestCache
+import harvestTransport
+import standinServer
+import tempfile
+
+
+class ResponseCache(unittest.TestCase):
+    """Cached GETs, Revalidation and Eviction, No Network Needed."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = standinServer.startServer(records=250)
+        cls.itemsURL = cls.server.baseURL + '/v2/items'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        harvestTransport.setCache(tmpdir.name, 3600, 1048576)
+        self.addCleanup(harvestTransport.setCache, None, 0, 0)
+
+    def testRequestURL(self):
+        """Params are Sorted and the API Key Left Out of the Cache Key."""
+        self.assertEqual(harvestCache.requestURL(self.itemsURL + '?b=2&api_key=x',
+                                                 {'a': 1}),
+                         self.itemsURL + '?a=1&b=2')
+
+    def testCache(self):
+        """Repeats Come from the Cache, Revalidated Once Stale."""
+        fetched = self.server.requestCount
+        first = harvestTransport.get(self.itemsURL,
+                                     params={'api_key': 'one', 'page': 2})
+        again = harvestTransport.get(self.itemsURL,
+                                     params={'page': 2, 'api_key': 'two'})
+        self.assertEqual(self.server.requestCount - fetched, 1)
+        self.assertEqual(again.content, first.content)
+        self.assertNotIn('api_key', again.url)
+        harvestTransport.cache.ttl = 0
+        stale = harvestTransport.get(self.itemsURL, params={'page': 2})
+        self.assertEqual(self.server.requestCount - fetched, 2)
+        self.assertEqual(harvestTransport.cache.revalidated, 1)
+        self.assertEqual(stale.content, first.content)
+        # Only the Most Recently Used Response Fits
+        harvestTransport.cache.maxBytes = len(first.content) + 1
+        harvestTransport.get(self.itemsURL, params={'page': 3})
+        self.assertEqual(len(harvestTransport.cache.sizes), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,9 +2,31 @@
 import unittest
 from harvestOAI import getFile
 from harvestOAI import writeHarvest
+from harvestOAI import processPage
+from harvestOAI import RecordWriter
+from harvestOAI import Sanitizer
+from harvestOAI import harvestRecords
+from harvestOAI import harvestPipelined
+from harvestOAI import harvestRefetch
+from harvestOAI import harvestIndex
+from argparse import Namespace
+import harvestArchive
+import harvestMetrics
+import harvestOAI
+import harvestOutput
+import harvestScheduler
+import harvestTransport
+import standinServer
+import json
+import os
+import tempfile
+from lxml import etree
+import io
 import re
 import requests
-import codecs
+import socket
+import time
+from email.utils import formatdate
 
 error_urls = [400, 401, 402, 403, 404, 405, 406, 407, 408, 409, 415, 416, 500,
               501, 502, 504, 505, 511, 520]
@@ -61,7 +83,7 @@ class WriteHarvest(unittest.TestCase):
         id_resp = requests.get('https://ecommons.cornell.edu/dspace-oai/request?verb=ListIdentifiers&metadataPrefix=oai_dc&set=com_1813_2939')
         golden_recCount = len(re.findall('<identifier>', id_resp.text))
         dataClean = open('harvest/fixtures/test_OAINoResumptionDataClean_fixture.txt').read()
-        ofile = codecs.lookup('utf-8')[-1](open('harvest/fixtures/test_OAINoResumptionDataOut_test.xml', 'wb'))
+        ofile = open('harvest/fixtures/test_OAINoResumptionDataOut_test.xml', 'wb')
         test_recCount = writeHarvest('https://ecommons.cornell.edu/dspace-oai', dataClean, ofile)
         ofile.close()
         self.assertEqual(golden_recCount, test_recCount)
@@ -75,5 +97,626 @@ class WriteHarvest(unittest.TestCase):
         pass
 
 
+class ProcessPage(unittest.TestCase):
+
+    def setUp(self):
+        self.page = open('harvest/fixtures/test_OAINoResumptionDataClean_fixture.txt', 'rb').read()
+
+    def testChunkedPage(self):
+        """Records Split Across Chunks Are Written Whole, No Token on Last Page."""
+        ofile = io.BytesIO()
+        writer = RecordWriter(ofile)
+        chunks = [self.page[i:i + 1000] for i in range(0, len(self.page), 1000)]
+        token = processPage(chunks, writer)
+        self.assertIsNone(token)
+        self.assertEqual(writer.recordCount, 15)
+        out = etree.fromstring(b'<out>' + ofile.getvalue() + b'</out>')
+        self.assertEqual(len(out), 15)
+
+    def testResumptionToken(self):
+        """Return the resumptionToken Text When the Page Has One."""
+        page = self.page.replace(b'</ListRecords>', b'<resumptionToken cursor="0">abc:100</resumptionToken></ListRecords>')
+        self.assertEqual(processPage([page], RecordWriter(io.BytesIO())), 'abc:100')
+
+    def testCutOffPage(self):
+        """A Page Ending Early Raises Rather than Looking Like the Last Page."""
+        page = self.page.replace(b'</ListRecords>', b'<resumptionToken cursor="0">abc:100</resumptionToken></ListRecords>')
+        writer = RecordWriter(io.BytesIO())
+        with self.assertRaises(harvestOAI.IncompletePage):
+            processPage([page[:len(page) // 2]], writer)
+        self.assertLess(writer.recordCount, 15)
+
+
+class SanitizePage(unittest.TestCase):
+
+    def testCleanPageUnchanged(self):
+        """Pages Without Illegal Characters Come Back Untouched."""
+        page = u'<title>caf\xe9 \ufffd</title>'.encode('utf-8')
+        sanitizer = Sanitizer()
+        self.assertEqual(sanitizer.feed(page) + sanitizer.flush(), page)
+        self.assertEqual(sanitizer.replaced, 0)
+
+    def testSplitSequences(self):
+        """Illegal Characters are Replaced Even When Split Across Chunks."""
+        page = u'<t>a\x01b\uffffc\ufffed</t>'.encode('utf-8')
+        for size in range(1, 5):
+            sanitizer = Sanitizer()
+            chunks = [page[i:i + size] for i in range(0, len(page), size)]
+            out = b''.join(sanitizer.feed(chunk) for chunk in chunks)
+            out += sanitizer.flush()
+            self.assertEqual(out, b'<t>a?b?c?d</t>')
+            self.assertEqual(sanitizer.replaced, 3)
+
+
+class AdaptiveConcurrency(unittest.TestCase):
+    """Additive Increase, Multiplicative Decrease of Requests in Flight."""
+
+    def runRequests(self, controller, latencies, overloaded=False):
+        numbers = [controller.acquire() for n in latencies]
+        for number, latency in zip(numbers, latencies):
+            controller.observe(number, latency, overloaded)
+            controller.release()
+
+    def testIncreaseAndCut(self):
+        controller = harvestTransport.HostController('test', 8)
+        for limit in range(1, 6):
+            self.runRequests(controller, [0.1] * limit)
+        self.assertEqual(controller.limit, 6)
+        # Only one cut for the requests in flight when the host pushed back.
+        self.runRequests(controller, [0.1] * 6, overloaded=True)
+        self.assertEqual(controller.limit, 3)
+        self.runRequests(controller, [0.5] * 3)
+        self.assertEqual(controller.limit, 1)
+
+    def testMaximum(self):
+        controller = harvestTransport.HostController('test', 2)
+        for n in range(5):
+            self.runRequests(controller, [0.1] * controller.limit)
+        self.assertEqual(controller.limit, 2)
+
+
+class OutputFiles(unittest.TestCase):
+    """Compressed Harvest Files."""
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmpdir = tmpdir.name
+
+    def testGzipRoundTrip(self):
+        fname = os.path.join(self.tmpdir, 'harvest.xml.gz')
+        writer = harvestOAI.openWriter(fname)
+        self.assertFalse(writer.resumable())
+        writer.start()
+        for n in range(3):
+            writer.writeBytes(('<record xmlns="http://www.openarchives.org/\
+OAI/2.0/"><header><identifier>oai:%d</identifier></header></record>'
+                               % n).encode('utf-8'))
+        writer.close()
+        with open(fname, 'rb') as gzfile:
+            header = gzfile.read(10)
+        self.assertEqual(header[:2], b'\x1f\x8b')
+        # The Extra Flags Byte is 2 at Level 9, 0 at the Levels in Between
+        self.assertEqual(header[8:9], b'\x00')
+        self.assertEqual(list(harvestIndex(fname)), ['oai:0', 'oai:1', 'oai:2'])
+
+        textName = os.path.join(self.tmpdir, 'report.txt.gz')
+        with harvestOutput.openOutput(textName, text=True) as tfile:
+            tfile.write('caf\u00e9\n')
+        with harvestOutput.openInput(textName) as tfile:
+            self.assertEqual(tfile.read().decode('utf-8'), 'caf\u00e9\n')
+
+    def records(self, numbers):
+        for n in numbers:
+            yield etree.fromstring(
+                '<record xmlns="http://www.openarchives.org/OAI/2.0/"><header>'
+                '<identifier>oai:%d</identifier><datestamp>2017-01-%02d'
+                '</datestamp></header></record>' % (n, n // 10 + 1))
+
+    def testShards(self):
+        """A New Shard Every maxRecords, Each a Complete File, Listed in the
+           Manifest with its Datestamp Range."""
+        writer = harvestOAI.ShardedRecordWriter(
+            os.path.join(self.tmpdir, 'harvest.xml'), maxRecords=100)
+        writer.start()
+        for elem in self.records(range(250)):
+            writer.write(elem)
+        writer.close()
+        with open(os.path.join(self.tmpdir, 'harvest.manifest.json')) as mfile:
+            manifest = json.load(mfile)
+        self.assertEqual(manifest['recordCount'], 250)
+        self.assertEqual([(shard['file'], shard['records'], shard['from'],
+                           shard['until']) for shard in manifest['shards']],
+                         [('harvest.00000.xml', 100, '2017-01-01', '2017-01-10'),
+                          ('harvest.00001.xml', 100, '2017-01-11', '2017-01-20'),
+                          ('harvest.00002.xml', 50, '2017-01-21', '2017-01-25')])
+        for n, shard in enumerate(manifest['shards']):
+            fname = os.path.join(self.tmpdir, shard['file'])
+            self.assertEqual(list(harvestIndex(fname)),
+                             ['oai:%d' % i for i in range(n * 100, n * 100 +
+                                                          shard['records'])])
+
+    def testShardRollback(self):
+        """Rolling Back Past the Start of a Shard Drops it and Reopens the
+           One Before."""
+        writer = harvestOAI.ShardedRecordWriter(
+            os.path.join(self.tmpdir, 'harvest.xml'), maxRecords=100)
+        writer.start()
+        for elem in self.records(range(95)):
+            writer.write(elem)
+        mark = writer.mark()
+        for elem in self.records(range(95, 110)):
+            writer.write(elem)
+        self.assertEqual(len(writer.shards), 2)
+        writer.rollback(mark)
+        self.assertEqual(len(writer.shards), 1)
+        self.assertFalse(os.path.exists(writer.shardFilename(1)))
+        for elem in self.records(range(95, 110)):
+            writer.write(elem)
+        writer.close()
+        self.assertEqual(writer.recordCount, 110)
+        self.assertEqual([shard['records'] for shard in writer.shards], [100, 10])
+        ids = (list(harvestIndex(writer.shardFilename(0))) +
+               list(harvestIndex(writer.shardFilename(1))))
+        self.assertEqual(ids, ['oai:%d' % n for n in range(110)])
+
+
+class Retries(unittest.TestCase):
+    """Retrying Failed Requests and Pages Cut off Part Way."""
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmpdir = tmpdir.name
+        self.setTransport('BACKOFF_BASE', 0.01)
+
+    def setTransport(self, name, value):
+        self.addCleanup(setattr, harvestTransport, name,
+                        getattr(harvestTransport, name))
+        setattr(harvestTransport, name, value)
+
+    def startServer(self, **kwargs):
+        server = standinServer.startServer(records=250, pageSize=40, **kwargs)
+        self.addCleanup(server.shutdown)
+        return(server)
+
+    def testBackoff(self):
+        for attempt in range(1, 12):
+            wait = min(harvestTransport.BACKOFF_MAX,
+                       harvestTransport.BACKOFF_BASE * 2 ** (attempt - 1))
+            self.assertTrue(wait / 2 <= harvestTransport.backoff(attempt) <= wait)
+
+    def testRetryAfter(self):
+        resp = requests.Response()
+        self.assertIsNone(harvestTransport.retryAfter(resp))
+        for value, wait in (('7', 7), ('-3', 0), ('soon', None),
+                            (formatdate(time.time() - 60, usegmt=True), 0)):
+            resp.headers['Retry-After'] = value
+            self.assertEqual(harvestTransport.retryAfter(resp), wait)
+        resp.headers['Retry-After'] = formatdate(time.time() + 30, usegmt=True)
+        self.assertAlmostEqual(harvestTransport.retryAfter(resp), 30, delta=2)
+
+    def testStatusRetries(self):
+        """503s are Retried, and the Last One Returned Once Out of Attempts."""
+        server = self.startServer(failEvery=2, retryAfter=0)
+        resp = harvestTransport.get(server.baseURL + '/oai?verb=Identify')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(server.requestCount, 1)
+        resp = harvestTransport.get(server.baseURL + '/oai?verb=Identify')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(server.requestCount, 3)
+
+        server = self.startServer(failEvery=1, retryAfter=0)
+        resp = harvestTransport.get(server.baseURL + '/oai?verb=Identify')
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(server.requestCount, harvestTransport.MAX_ATTEMPTS)
+
+    def testAttemptsPerFailure(self):
+        """Dropped Connections and 503s Run Out of Attempts Separately."""
+        self.setTransport('MAX_ATTEMPTS', 3)
+        # Odd Requests are Cut Off, Even Ones Get a 503
+        server = self.startServer(failEvery=2, truncateEvery=1, retryAfter=0)
+        with self.assertRaises(harvestTransport.HarvestError):
+            harvestTransport.get(server.baseURL + '/oai?verb=Identify')
+        self.assertEqual(server.requestCount, 5)
+
+    def testRefused(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        with self.assertRaises(harvestTransport.HarvestError):
+            harvestTransport.get('http://127.0.0.1:%d/oai' % port)
+
+    def testSlotReleased(self):
+        """A Request that Fails Without Being Retried Gives its Slot Back."""
+        server = self.startServer()
+        self.addCleanup(harvestTransport.setAdaptive, None)
+        self.addCleanup(harvestTransport.setConnectionCap, None)
+        harvestTransport.setAdaptive(1)
+        harvestTransport.setConnectionCap(1)
+        url = server.baseURL + '/oai?verb=Identify'
+        for n in range(2):
+            with self.assertRaises(requests.TooManyRedirects):
+                harvestTransport.get(url, allow_redirects=True,
+                                     hooks={'response': self.redirect})
+        self.assertEqual(harvestTransport.get(url).status_code, 200)
+
+    @staticmethod
+    def redirect(resp, *args, **kwargs):
+        # Every Response Sends the Client Back to the Same URL
+        resp.status_code = 302
+        resp.headers['Location'] = resp.url
+        return(resp)
+
+    def testCutOffPage(self):
+        """Records from a Page Cut off Part Way are Rolled Back and the Page
+           Requested Again."""
+        server = self.startServer(truncateEvery=3)
+        fname = os.path.join(self.tmpdir, 'harvest.xml')
+        writer = harvestOAI.openWriter(fname)
+        writer.start()
+        self.assertEqual(harvestRecords(server.baseURL + '/oai',
+                                        'ListRecords&metadataPrefix=oai_dc',
+                                        writer), 250)
+        writer.close()
+        self.assertEqual(server.requestCount, 10)
+        ids = list(harvestIndex(fname))
+        self.assertEqual(ids, ['oai:standin:%d' % n for n in range(250)])
+
+    def testCutOffMergedSets(self):
+        """Sets Sharing a File are Written a Whole Page at a Time, so a Page
+           Cut off Part Way Leaves Nothing Behind."""
+        server = self.startServer(truncateEvery=3)
+        args = Namespace(link=server.baseURL + '/oai',
+                         fname=os.path.join(self.tmpdir, 'harvest.xml'),
+                         setName=None, fromDate=None, until=None,
+                         mdprefix='oai_dc', workers=2, prefetch=0,
+                         splitSets=False)
+        expected = set('oai:standin:%d' % n
+                       for setSpec in ('set_0', 'set_1')
+                       for n in server.repository.sets[setSpec])
+        self.assertEqual(harvestOAI.harvestSets(args, ['set_0', 'set_1']),
+                         len(expected))
+        ids = list(harvestIndex(args.fname))
+        self.assertEqual(len(ids), len(expected))
+        self.assertEqual(set(ids), expected)
+
+
+class StandinHarvest(unittest.TestCase):
+    """Harvest from the Local Stand-in Server, No Network Needed."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = standinServer.startServer(records=250, pageSize=40)
+        cls.link = cls.server.baseURL + '/oai'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmpdir = tmpdir.name
+
+    def harvestArgs(self, **kwargs):
+        """Command line options for a harvest of the stand-in into tmpdir."""
+        args = Namespace(link=self.link, fname=os.path.join(self.tmpdir,
+                                                            'harvest.xml'),
+                         setName=None, fromDate=None, until=None,
+                         mdprefix='oai_dc', workers=3, prefetch=0,
+                         splitSets=False, windows=0)
+        for name, value in kwargs.items():
+            setattr(args, name, value)
+        return(args)
+
+    def standinIds(self, setSpec=None):
+        return(set('oai:standin:%d' % n
+                   for n in self.server.repository.sets[setSpec]))
+
+    def harvestIds(self, harvest, *args):
+        ofile = io.BytesIO()
+        writer = RecordWriter(ofile)
+        count = harvest(self.link, 'ListRecords&metadataPrefix=oai_dc', writer, *args)
+        out = etree.fromstring(b'<out>' + ofile.getvalue() + b'</out>')
+        ids = [rec.findtext('{http://www.openarchives.org/OAI/2.0/}header/{http://www.openarchives.org/OAI/2.0/}identifier') for rec in out]
+        self.assertEqual(count, len(ids))
+        return(ids)
+
+    def testResumption(self):
+        """Follow resumptionTokens Until Every Record is Written Once."""
+        ids = self.harvestIds(harvestRecords)
+        self.assertEqual(ids, ['oai:standin:%d' % n for n in range(250)])
+
+    def testPipelined(self):
+        """Pipelined Harvest Writes the Same Records in the Same Order."""
+        self.assertEqual(self.harvestIds(harvestPipelined, 2),
+                         self.harvestIds(harvestRecords))
+
+    def testMergedSets(self):
+        """Records in Overlapping Sets are Written Once to a Merged File."""
+        args = self.harvestArgs()
+        self.assertTrue(self.standinIds('set_0') & self.standinIds('set_1'))
+        self.assertEqual(harvestOAI.harvestSets(args, ['set_0', 'set_1']),
+                         len(self.standinIds('set_0') | self.standinIds('set_1')))
+        self.assertEqual(set(harvestIndex(args.fname)),
+                         self.standinIds('set_0') | self.standinIds('set_1'))
+
+    def testFailedSet(self):
+        """A Set that Fails Leaves a Well-Formed File and Exits Non-Zero."""
+        args = self.harvestArgs()
+        with self.assertRaises(SystemExit) as cm:
+            harvestOAI.harvestSets(args, ['set_0', 'missing'])
+        self.assertEqual(cm.exception.code, 1)
+        self.assertEqual(set(harvestIndex(args.fname)), self.standinIds('set_0'))
+
+    def testSplitSets(self):
+        """Each Set is Written Whole to its Own File."""
+        args = self.harvestArgs(splitSets=True)
+        harvestOAI.harvestSets(args, ['set_0', 'set_1'])
+        for setSpec in ('set_0', 'set_1'):
+            fname = harvestOAI.setFilename(args.fname, setSpec)
+            self.assertEqual(set(harvestIndex(fname)), self.standinIds(setSpec))
+
+    def testResume(self):
+        """A Chain Stopped Part Way Resumes from its Checkpoint Without
+           Losing or Repeating Records."""
+        fname = os.path.join(self.tmpdir, 'harvest.xml')
+        command = 'ListRecords&metadataPrefix=oai_dc'
+        writer = harvestOAI.openWriter(fname)
+        writer.start()
+        onPage = harvestOAI.checkpointer(fname, self.link, writer)
+        onPage(command)
+        pages = []
+
+        def stopAfterThree(nextCommand):
+            onPage(nextCommand)
+            pages.append(nextCommand)
+            if len(pages) == 3:
+                raise KeyboardInterrupt()
+        with self.assertRaises(KeyboardInterrupt):
+            harvestOAI.harvestRecords(self.link, command, writer,
+                                      stopAfterThree)
+        # Half a Page Written After the Checkpoint, Then Closed as main Does
+        writer.ofile.write(b'<record><header><identifier>oai:standin:0')
+        writer.close()
+
+        checkpoint = harvestOAI.loadCheckpoint(fname)
+        self.assertEqual(checkpoint['recordCount'], 120)
+        writer = harvestOAI.resumeWriter(fname, checkpoint)
+        harvestOAI.harvestRecords(
+            self.link, checkpoint['command'], writer,
+            harvestOAI.checkpointer(fname, self.link, writer))
+        writer.close()
+        self.assertEqual(writer.recordCount, 250)
+        ids = list(harvestIndex(fname))
+        self.assertEqual(len(ids), 250)
+        self.assertEqual(set(ids), self.standinIds())
+
+    def harvestUntil(self, fname, until):
+        writer = harvestOAI.openWriter(fname)
+        writer.start()
+        harvestOAI.harvestRecords(self.link, 'ListRecords&metadataPrefix=\
+oai_dc&until=%s' % until, writer)
+        writer.close()
+        return(writer.recordCount)
+
+    def testMergeHarvest(self):
+        """Updates Replace Records in Place, Deletions Replace the Record
+           with its Header, and New Records are Added at the End."""
+        fname = os.path.join(self.tmpdir, 'harvest.xml')
+        self.harvestUntil(fname, '2017-01-02')
+        self.assertEqual(harvestOAI.lastHarvestDate(fname),
+                         self.server.repository.datestamps[47])
+        record = ('<record xmlns="http://www.openarchives.org/OAI/2.0/">'
+                  '<header%s><identifier>%s</identifier></header>%s</record>')
+        updates = {
+            'oai:standin:3': (record % ('', 'oai:standin:3',
+                                        '<metadata>updated</metadata>')).encode('utf-8'),
+            'oai:standin:5': (record % (' status="deleted"', 'oai:standin:5',
+                                        '')).encode('utf-8'),
+            'oai:new': (record % ('', 'oai:new', '')).encode('utf-8')}
+        self.assertEqual(harvestOAI.mergeHarvest(fname, updates), (2, 1, 1))
+        ids = list(harvestIndex(fname))
+        self.assertEqual(ids, ['oai:standin:%d' % n for n in range(48)]
+                         + ['oai:new'])
+        root = etree.parse(fname).getroot()
+        records = root.findall('.//' + harvestOAI.OAI_NS + 'record')
+        self.assertEqual(records[3].findtext(harvestOAI.OAI_NS + 'metadata'),
+                         'updated')
+        self.assertEqual(records[5][0].get('status'), 'deleted')
+        self.assertIsNone(records[5].find(harvestOAI.OAI_NS + 'metadata'))
+
+    def testIncremental(self):
+        """An Incremental Run Picks Up from the Last Datestamp, Replacing the
+           Overlapping Day and Appending the Rest."""
+        args = self.harvestArgs(incremental=True)
+        self.assertEqual(self.harvestUntil(args.fname, '2017-01-05'), 120)
+        self.assertEqual(harvestOAI.harvestIncremental(args), 250 - 96)
+        self.assertEqual(args.fromDate, '2017-01-05')
+        self.assertEqual(list(harvestIndex(args.fname)),
+                         ['oai:standin:%d' % n for n in range(250)])
+        self.assertFalse(os.path.exists(args.fname + '.merge'))
+
+    def testIncrementalUnchanged(self):
+        """A Run with No Changes Leaves the Harvest File Alone."""
+        args = self.harvestArgs(fromDate='2017-02-01')
+        self.harvestUntil(args.fname, '2017-01-02')
+        modified = os.stat(args.fname).st_mtime_ns
+        self.assertEqual(harvestOAI.harvestIncremental(args), 0)
+        self.assertEqual(os.stat(args.fname).st_mtime_ns, modified)
+
+    def testDateWindows(self):
+        """A Date Range Splits into Whole-Day Windows that Cover it Once."""
+        self.assertEqual(harvestOAI.dateWindows('2020-01-01', '2020-01-10', 3),
+                         [('2020-01-01', '2020-01-03'),
+                          ('2020-01-04', '2020-01-06'),
+                          ('2020-01-07', '2020-01-10')])
+        self.assertEqual(harvestOAI.dateWindows('2020-01-01', '2020-01-02', 5),
+                         [('2020-01-01', '2020-01-01'),
+                          ('2020-01-02', '2020-01-02')])
+
+    def testWindowRerun(self):
+        """A Rerun Only Harvests the Windows the Manifest Doesn't List."""
+        args = self.harvestArgs(fromDate='2017-01-01', until='2017-01-11',
+                                windows=3)
+        first = harvestOAI.dateWindows(args.fromDate, args.until, 3)[0]
+        with open('%s.%s_%s' % ((args.fname,) + first), 'wb') as wfile:
+            wfile.write(b'<record xmlns="http://www.openarchives.org/OAI/2.0/">'
+                        b'<header><identifier>oai:done</identifier></header>'
+                        b'</record>')
+        with open(args.fname + '.windows.json', 'w') as mfile:
+            json.dump({'%s_%s' % first: 1}, mfile)
+        self.assertEqual(harvestOAI.harvestWindows(args),
+                         1 + len([d for d in self.server.repository.datestamps
+                                  if d[:10] > first[1]]))
+        ids = list(harvestIndex(args.fname))
+        self.assertEqual(ids[0], 'oai:done')
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ['harvest.xml'])
+
+    def testRefetch(self):
+        """Only Missing and Changed Records are Fetched Again with GetRecord."""
+        fname = os.path.join(self.tmpdir, 'harvest.xml')
+        writer = RecordWriter(open(fname, 'wb'))
+        writer.start()
+        harvestRecords(self.link, 'ListRecords&metadataPrefix=oai_dc', writer)
+        writer.close()
+        full = harvestIndex(fname)
+        with open(fname, 'rb') as hfile:
+            data = hfile.read()
+        records = re.findall(b'<record.*?</record>', data, re.S)
+        records[3] = records[3].replace(b'<datestamp>', b'<datestamp>1999', 1)
+        with open(fname, 'wb') as hfile:
+            hfile.write(data[:data.index(b'<record')] + b''.join(records[:200]) +
+                        data[data.rindex(b'</record>') + 9:])
+        args = Namespace(link=self.link, fname=fname, setName=None,
+                         fromDate=None, until=None, mdprefix='oai_dc',
+                         workers=3)
+        self.assertEqual(harvestRefetch(args), 51)
+        self.assertEqual(harvestIndex(fname), full)
+
+    def testScheduler(self):
+        """Endpoints Harvest Side by Side, Each into its Own File."""
+        endpoints = [{'name': setSpec, 'link': self.link, 'set': setSpec,
+                      'output': os.path.join(self.tmpdir, setSpec + '.xml')}
+                     for setSpec in ('set_0', 'set_1', 'missing')]
+        results = harvestScheduler.runHarvests(endpoints, 3)
+        self.assertEqual([r['status'] for r in results], ['ok', 'ok', 'failed'])
+        self.assertEqual([r['records'] for r in results], [75, 76, 0])
+        self.assertEqual(len(harvestIndex(endpoints[0]['output'])), 75)
+
+    def testArchive(self):
+        """A Harvest Rebuilt from its Archived Pages Has the Same Records."""
+        fname = os.path.join(self.tmpdir, 'harvest.xml')
+        harvestOAI.pageArchive = harvestArchive.PageArchive(
+            os.path.join(self.tmpdir, 'pages.warc.gz'))
+        try:
+            writer = RecordWriter(open(fname, 'wb'))
+            writer.start()
+            harvestRecords(self.link, 'ListRecords&metadataPrefix=oai_dc', writer)
+            writer.close()
+        finally:
+            harvestOAI.pageArchive.close()
+            harvestOAI.pageArchive = None
+        index = harvestArchive.indexArchive(os.path.join(self.tmpdir,
+                                                         'pages.warc.gz'))
+        self.assertEqual(len(index), 7)
+        args = Namespace(fname=os.path.join(self.tmpdir, 'rebuilt.xml'),
+                         fromArchive=os.path.join(self.tmpdir, 'pages.warc.gz'))
+        self.assertEqual(harvestOAI.harvestFromArchive(args), 250)
+        self.assertEqual(harvestIndex(args.fname), harvestIndex(fname))
+
+    def testArchiveIncremental(self):
+        """A Rebuild Keeps the Newest Copy of Each Record, and Repositories
+           Sharing an Archive Don't Replace Each Other's Pages."""
+        def page(records, token=''):
+            return((harvestOAI.oaistart % '2020-02-01T00:00:00Z' +
+                    ''.join('<record><header%s><identifier>%s</identifier>'
+                            '</header>%s</record>' % record
+                            for record in records) +
+                    '<resumptionToken>%s</resumptionToken>' % token +
+                    harvestOAI.oaiend).encode('utf-8'))
+        full = 'ListRecords&metadataPrefix=oai_dc'
+        pages = harvestArchive.PageArchive(os.path.join(self.tmpdir,
+                                                        'pages.warc.gz'))
+        for link, command, data in (
+                ('http://a/oai', full, page([('', 'a:1', '<metadata/>'),
+                                             ('', 'a:2', '<metadata>old</metadata>')],
+                                            'more')),
+                ('http://a/oai', 'ListRecords&resumptionToken=more',
+                 page([('', 'a:3', '<metadata/>')])),
+                ('http://b/oai', full, page([('', 'b:1', '<metadata/>')])),
+                ('http://a/oai', full + '&from=2020-01-01',
+                 page([('', 'a:2', '<metadata>new</metadata>'),
+                       (' status="deleted"', 'a:3', '')]))):
+            pages.write(link + '?verb=' + command, command, data)
+        pages.close()
+
+        args = Namespace(fname=os.path.join(self.tmpdir, 'rebuilt.xml'),
+                         fromArchive=os.path.join(self.tmpdir, 'pages.warc.gz'))
+        self.assertEqual(harvestOAI.harvestFromArchive(args), 4)
+        self.assertEqual(sorted(harvestIndex(args.fname)),
+                         ['a:1', 'a:2', 'a:3', 'b:1'])
+        records = dict((harvestOAI.recordIdentifier(elem), elem) for elem in
+                       etree.parse(args.fname).getroot().iter(
+                           harvestOAI.OAI_NS + 'record'))
+        self.assertEqual(records['a:2'].findtext(harvestOAI.OAI_NS + 'metadata'),
+                         'new')
+        self.assertEqual(records['a:3'][0].get('status'), 'deleted')
+
+    def testArchiveCutOff(self):
+        """Pages Appended After a Record Cut Off Part Way are Still Read."""
+        fname = os.path.join(self.tmpdir, 'pages.warc.gz')
+        pages = harvestArchive.PageArchive(fname)
+        pages.write('http://a/oai?verb=one', 'one', b'<page>one</page>')
+        pages.write('http://a/oai?verb=two', 'two', b'<page>two</page>' * 500)
+        pages.close()
+        second = harvestArchive.indexArchive(fname)['http://a/oai?verb=two']
+        with open(fname, 'r+b') as afile:
+            afile.truncate((second + os.path.getsize(fname)) // 2)
+        pages = harvestArchive.PageArchive(fname)
+        pages.write('http://a/oai?verb=three', 'three', b'<page>three</page>')
+        pages.close()
+        index = harvestArchive.indexArchive(fname)
+        self.assertEqual(list(index), ['http://a/oai?verb=one',
+                                       'http://a/oai?verb=three'])
+        with open(fname, 'rb') as afile:
+            self.assertEqual(harvestArchive.readPage(
+                afile, index['http://a/oai?verb=three']), b'<page>three</page>')
+
+    def testAnalysis(self):
+        """Records are Counted for the Field Report as they are Harvested."""
+        analyzer = harvestOAI.AnalysisWriter(harvestOAI.loadAnalysis('oaidc'),
+                                             RecordWriter(io.BytesIO()))
+        self.assertEqual(harvestRecords(self.link, 'ListRecords&metadataPrefix=oai_dc',
+                                        analyzer), 250)
+        self.assertEqual(analyzer.stats['record_count'], 250)
+        self.assertEqual(analyzer.stats['field_info']
+                         ['{http://purl.org/dc/elements/1.1/}subject']
+                         ['field_count_total'], 500)
+
+    def testMetrics(self):
+        """Every Request and Page is Recorded, with the Right Record Counts."""
+        jsonPath = os.path.join(self.tmpdir, 'metrics.jsonl')
+        promPath = os.path.join(self.tmpdir, 'harvest.prom')
+        harvestMetrics.enable('test', jsonPath, promPath)
+        try:
+            self.harvestIds(harvestRecords)
+        finally:
+            harvestMetrics.recorder.close()
+            harvestMetrics.recorder = None
+        with open(jsonPath) as mfile:
+            entries = [json.loads(line) for line in mfile]
+        reqs = [e for e in entries if e['event'] == 'request']
+        pages = [e for e in entries if e['event'] == 'page']
+        self.assertEqual(len(reqs), 7)
+        self.assertEqual([e['records'] for e in pages], [40] * 6 + [10])
+        self.assertTrue(all(e['total'] >= e['firstByte'] for e in reqs))
+        with open(promPath) as pfile:
+            self.assertIn('harvest_records_total{job="test"} 250', pfile.read())
+
+
 if __name__ == '__main__':
     unittest.main()
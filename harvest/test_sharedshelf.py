@@ -0,0 +1,57 @@
+"""Testing the SharedShelf Harvest Module Against the Local Stand-in Server."""
+import unittest
+import harvestSharedShelf
+import standinServer
+import json
+import os
+import tempfile
+
+
+class StandinSharedShelf(unittest.TestCase):
+    """Harvest from the Stand-in's SharedShelf API, No Login Needed."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = standinServer.startServer(records=250)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmpdir = tmpdir.name
+        self.addCleanup(setattr, harvestSharedShelf, 'base_url',
+                        harvestSharedShelf.base_url)
+        self.addCleanup(setattr, harvestSharedShelf, 'PAGE_SIZE',
+                        harvestSharedShelf.PAGE_SIZE)
+        harvestSharedShelf.base_url = self.server.baseURL + '/'
+        harvestSharedShelf.PAGE_SIZE = 100
+
+    def testSharedShelfPages(self):
+        """SharedShelf Assets are Paged Through and Written Out Mapped."""
+        fname = os.path.join(self.tmpdir, 'assets.json')
+        fetched = self.server.requestCount
+        harvestSharedShelf.generateDataDump(None, {1: 'Stand-in Project'},
+                                            fname)
+        self.assertEqual(self.server.requestCount - fetched, 3)
+        with open(fname) as afile:
+            assets = json.load(afile)
+        self.assertEqual(len(assets), 250)
+        self.assertEqual(assets['7'], {'id': 7, 'project_id': 1,
+                                       'Title': 'Stand-in asset 7',
+                                       'Subject_facet': ['Subject 0'],
+                                       'Date': '2017-01-01'})
+
+    def testSharedShelfCappedPages(self):
+        """Paging Goes On to the Total When Pages are Capped Below PAGE_SIZE."""
+        harvestSharedShelf.PAGE_SIZE = 250
+        pages = list(harvestSharedShelf.iterAssetPages(
+            harvestSharedShelf.base_url, 1, None))
+        self.assertEqual([len(page['assets']) for page in pages],
+                         [100, 100, 50])
+
+
+if __name__ == '__main__':
+    unittest.main()